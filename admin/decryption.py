@@ -0,0 +1,67 @@
+# IMPORTS
+from cryptography.fernet import Fernet
+
+from admin.pools import SpawnPool
+
+# CONFIG
+# chunks smaller than this are decrypted in-process (not worth the round trip to the pool)
+PARALLEL_THRESHOLD = 500
+# number of tasks handed to each worker per chunk (smooths out owners with many draws)
+TASKS_PER_WORKER = 4
+
+# process pool shared by every settlement in this worker
+executor = SpawnPool()
+
+
+# decrypt a batch of owner shards, building one Fernet instance per owner
+# (runs inside the pool, so this module must not import the app)
+def decrypt_shards(shards):
+    decrypted = []
+
+    for key, draws in shards:
+        cipher = Fernet(key)
+        for draw_id, numbers in draws:
+            decrypted.append((draw_id, tuple(sorted(int(n) for n in cipher.decrypt(numbers).decode('utf-8').split()))))
+
+    return decrypted
+
+
+# group draws by owner as (key, [(draw id, encrypted numbers)])
+def shard_by_owner(rows):
+    shards = {}
+
+    for row in rows:
+        if row.user_id not in shards:
+            shards[row.user_id] = (row.key, [])
+        shards[row.user_id][1].append((row.id, row.numbers))
+
+    return list(shards.values())
+
+
+# split the owner shards into roughly equal sized tasks
+def split_tasks(shards, count):
+    tasks = [[] for _ in range(count)]
+    sizes = [0] * count
+
+    # largest shards first, each to the currently smallest task
+    for shard in sorted(shards, key=lambda s: len(s[1]), reverse=True):
+        smallest = sizes.index(min(sizes))
+        tasks[smallest].append(shard)
+        sizes[smallest] += len(shard[1])
+
+    return [task for task in tasks if task]
+
+
+# decrypt a chunk of draws to {draw id: sorted number tuple}, in parallel when worthwhile
+def decrypt_draws(rows, workers=1):
+    shards = shard_by_owner(rows)
+
+    if workers <= 1 or len(rows) < PARALLEL_THRESHOLD:
+        return dict(decrypt_shards(shards))
+
+    pool = executor.get(workers)
+    decrypted = {}
+    for result in pool.map(decrypt_shards, split_tasks(shards, workers * TASKS_PER_WORKER)):
+        decrypted.update(result)
+
+    return decrypted
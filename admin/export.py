@@ -0,0 +1,90 @@
+# IMPORTS
+import csv
+import io
+import json
+import zlib
+
+from sqlalchemy import select
+
+import metrics
+import models
+import shards
+from admin import decryption, settlement
+from models import ArchivedDraw
+
+# CONFIG
+# columns of an exported row
+FIELDS = ('lottery_round', 'draw_id', 'user_id', 'email', 'numbers', 'matched_count', 'tier', 'jackpot')
+# rows fetched from the cursor, decrypted and written at a time
+BATCH_SIZE = 1000
+# gzip level (the export is compressed while it is streamed, so speed matters more than size)
+COMPRESSION_LEVEL = 6
+# export formats (the download itself is always gzip)
+FORMATS = ('csv', 'jsonl')
+
+
+# archived draws of a round (only those in a prize tier with winners_only) in batches of export rows, shard by
+# shard, fetched from a server-side cursor so only one batch is in memory at a time
+def round_rows(lottery_round, winners_only=False):
+    # no ORDER BY: rows come in index order, so SQLite does not sort the whole round before the first row
+    query = select(ArchivedDraw.draw_id.label('id'), ArchivedDraw.user_id, ArchivedDraw.numbers,
+                   ArchivedDraw.matched_count, ArchivedDraw.tier, ArchivedDraw.matches_master) \
+        .where(ArchivedDraw.lottery_round == lottery_round, ArchivedDraw.master_draw == False) \
+        .execution_options(yield_per=BATCH_SIZE)
+
+    if winners_only:
+        query = query.where(ArchivedDraw.tier != None)
+
+    for shard in range(shards.count()):
+        for batch in shards.execute(shard, query).partitions():
+            # the owners live in the main database, so they are looked up a batch at a time
+            owned_by = settlement.owners(row.user_id for row in batch)
+            with metrics.timer('fernet'):
+                decrypted = decryption.decrypt_draws(
+                    [settlement.OwnedDraw(row.id, row.user_id, row.numbers, owned_by[row.user_id].email,
+                                          owned_by[row.user_id].key) for row in batch])
+            yield [(lottery_round, row.id, row.user_id, owned_by[row.user_id].email,
+                    models.format_numbers(decrypted[row.id]), row.matched_count or 0, row.tier or '',
+                    bool(row.matches_master))
+                   for row in batch]
+
+
+# CSV text of the batches, one chunk per batch
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(FIELDS)
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+# JSON lines of the batches, one chunk per batch
+def jsonl_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(FIELDS, row))) + '\n' for row in batch)
+
+
+# gzip the text chunks on the fly
+def gzipped(chunks):
+    # wbits 31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+# gzipped export of a round in a format of FORMATS
+def export_round(lottery_round, export_format='csv', winners_only=False):
+    batches = round_rows(lottery_round, winners_only)
+    chunks = csv_chunks(batches) if export_format == 'csv' else jsonl_chunks(batches)
+    return gzipped(chunks)
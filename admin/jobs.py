@@ -0,0 +1,162 @@
+# IMPORTS
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+import shards
+from admin import settlement
+from app import db
+from models import Draw, RoundJob, RoundJobShard
+
+# CONFIG
+# settlement jobs run one at a time in a background thread of this worker
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='settlement')
+# futures of the jobs submitted by this worker
+running = {}
+# an unfinished job that has not committed a chunk for this long is treated as interrupted
+STALE_AFTER = timedelta(seconds=60)
+
+
+# run (or resume) a settlement job in the background thread
+def run_job(app, job_id):
+    with app.app_context():
+        job = db.session.get(RoundJob, job_id)
+        winning_draw = db.session.get(Draw, job.master_draw_id)
+
+        job.status = 'running'
+        job.updated_on = datetime.now()
+        db.session.commit()
+
+        try:
+            report = settlement.settle_round(winning_draw,
+                                             job=job,
+                                             workers=app.config['SETTLEMENT_WORKERS'],
+                                             prize_tiers=app.config['PRIZE_TIERS'])
+            # logged at WARNING like the app's other events (the root logger drops INFO)
+            logging.warning('Round %s settled by job %s: %s tickets in %.2fs (%.0f tickets/second)',
+                            report.lottery_round,
+                            job.id,
+                            report.processed,
+                            report.elapsed,
+                            report.tickets_per_second,
+                            extra={'event': 'round_settled'})
+        except Exception:
+            db.session.rollback()
+            logging.exception('Settlement job %s failed', job_id)
+            job = db.session.get(RoundJob, job_id)
+            job.status = 'failed'
+            job.updated_on = datetime.now()
+            db.session.commit()
+        finally:
+            running.pop(job_id, None)
+
+
+# check whether a job is still being worked on by this or another worker
+def is_active(job):
+    future = running.get(job.id)
+    if future is not None and not future.done():
+        return True
+
+    return job.status in ('queued', 'running') and datetime.now() - job.updated_on < STALE_AFTER
+
+
+# submit a job to the background thread
+def submit(job):
+    # the thread works in its own context of the requesting app
+    running[job.id] = executor.submit(run_job, current_app._get_current_object(), job.id)
+
+
+# start settling the round of a winning draw, resuming an interrupted job if there is one
+def start_job(winning_draw):
+    job = RoundJob.query.filter_by(master_draw_id=winning_draw.id) \
+        .filter(RoundJob.status != 'finished') \
+        .order_by(RoundJob.id.desc()) \
+        .first()
+
+    if job:
+        # the job is still in progress
+        if is_active(job):
+            return job
+
+        # resume the interrupted or failed job from its last committed chunks, unless another worker
+        # took it over first (its status or update time changed since it was read)
+        resumed = db.session.execute(
+            update(RoundJob)
+            .where(RoundJob.id == job.id, RoundJob.status == job.status, RoundJob.updated_on == job.updated_on)
+            .values(status='queued', updated_on=datetime.now())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not resumed:
+            db.session.rollback()
+            return job
+
+        # a job started before shards resumes on the main database from its own last committed chunk
+        if not job.shard_progress:
+            db.session.add(RoundJobShard(job.id, 0, job.max_draw_id, job.last_draw_id))
+
+        db.session.commit()
+        submit(job)
+        return job
+
+    # a new job settles every user draw entered up to now on each shard
+    max_draw_ids = [settlement.max_draw_id(shard) for shard in range(shards.count())]
+    total = sum(settlement.open_draws(shard, max_draw_id) for shard, max_draw_id in enumerate(max_draw_ids))
+
+    job = RoundJob(master_draw_id=winning_draw.id,
+                   lottery_round=winning_draw.lottery_round,
+                   max_draw_id=max(max_draw_ids),
+                   total=total)
+    db.session.add(job)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # another worker created the round's job first (one unfinished job per winning draw)
+        db.session.rollback()
+        return RoundJob.query.filter_by(master_draw_id=winning_draw.id) \
+            .filter(RoundJob.status != 'finished') \
+            .first()
+    for shard, max_draw_id in enumerate(max_draw_ids):
+        db.session.add(RoundJobShard(job.id, shard, max_draw_id))
+    db.session.commit()
+    submit(job)
+    return job
+
+
+# progress of a job for the status endpoint
+def job_status(job):
+    elapsed = ((job.finished_on or datetime.now()) - job.created_on).total_seconds()
+    remaining = job.total - job.processed
+
+    # average settlement rate so far, and the time left at that rate
+    rate = job.processed / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if job.status != 'finished' and rate:
+        eta = round(remaining / rate, 1)
+
+    status = {
+        'job': job.id,
+        'lottery_round': job.lottery_round,
+        'status': job.status,
+        'processed': job.processed,
+        'total': job.total,
+        'winners': job.winners,
+        'elapsed': round(elapsed, 1),
+        'tickets_per_second': round(rate, 1),
+        'eta': 0 if job.status == 'finished' else eta,
+        'tiers': settlement.tier_counts(job.lottery_round),
+    }
+
+    # progress of each shard's settlement process
+    if len(job.shard_progress) > 1:
+        status['shards'] = [{'shard': progress.shard, 'processed': progress.processed, 'winners': progress.winners}
+                            for progress in job.shard_progress]
+
+    # list the winners once the whole round is settled
+    if job.status == 'finished':
+        status['results'] = settlement.round_winners(job.lottery_round)
+
+    return status
@@ -0,0 +1,103 @@
+# IMPORTS
+import json
+import os
+
+# CONFIG
+# bytes read from the file per step backwards
+BLOCK_SIZE = 64 * 1024
+# longest part of a line kept in memory (the rest of a longer line is dropped)
+MAX_LINE = 4096
+# most bytes scanned by one call, so a rare filter cannot read a huge file in one request
+MAX_SCAN = 64 * 1024 * 1024
+
+
+# parse a JSON-lines audit entry (None for older plain text lines)
+def parse(line):
+    if not line.startswith('{'):
+        return None
+
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+
+    return entry if isinstance(entry, dict) else None
+
+
+# level of a log line (None for plain text lines)
+def line_level(line):
+    entry = parse(line)
+    return entry.get('level') if entry else None
+
+
+# readable form of a log line
+def display(line):
+    entry = parse(line)
+    if not entry:
+        return line
+
+    return '%s %s %s' % (entry.get('time', ''), entry.get('level', ''), entry.get('message', ''))
+
+
+# build a line filter from an optional level and user (email or id in the line)
+def matches(level=None, user=None):
+    def keep(line):
+        if level and line_level(line) != level.upper():
+            return False
+        if user and user not in line:
+            return False
+        return True
+
+    return keep
+
+
+# read the last count lines before the byte offset before (the end of the file when None), newest first
+# returns the lines and the offset to pass as before for the previous page (0 when the start was reached)
+def tail(path, count, before=None, keep=None):
+    lines = []
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell() if before is None else min(before, f.tell())
+
+        # end of the next line to look at
+        cursor = position
+        # earliest bytes seen so far of the line that continues in the previous block, and its real length
+        partial = b''
+        partial_length = 0
+        scanned = 0
+
+        while position > 0 and scanned < MAX_SCAN:
+            read = min(BLOCK_SIZE, position)
+            position -= read
+            scanned += read
+            f.seek(position)
+            parts = f.read(read).split(b'\n')
+
+            # the last part of the block continues the line started in the block after it
+            lengths = [len(part) for part in parts]
+            lengths[-1] += partial_length
+            parts[-1] = (parts[-1] + partial)[:MAX_LINE]
+
+            # the first part may continue in the block before this one
+            partial, partial_length = parts[0], lengths[0]
+
+            for raw, length in zip(reversed(parts[1:]), reversed(lengths[1:])):
+                start = cursor - length
+                cursor = start - 1
+
+                line = raw.decode('utf-8', errors='replace').rstrip('\r')
+                if line and (keep is None or keep(line)):
+                    lines.append(line)
+                    if len(lines) >= count:
+                        return lines, start
+
+        # the first line of the file
+        if position == 0:
+            line = partial.decode('utf-8', errors='replace').rstrip('\r')
+            if line and (keep is None or keep(line)):
+                lines.append(line)
+            return lines, 0
+
+    # scan limit reached: continue from the line that was not finished
+    return lines, cursor + 1
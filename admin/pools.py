@@ -0,0 +1,22 @@
+# IMPORTS
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# process pool created on first use and replaced when the number of workers changes (spawned, so its
+# processes do not inherit the app's threads and database connections)
+class SpawnPool:
+
+    def __init__(self):
+        self.executor = None
+        self.workers = 0
+
+    # get the pool for a number of workers
+    def get(self, workers):
+        if self.executor is None or self.workers != workers:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            self.workers = workers
+
+        return self.executor
@@ -0,0 +1,334 @@
+# IMPORTS
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select, update, func
+
+import models
+import shards
+from admin import decryption, tiers
+from admin.pools import SpawnPool
+from app import db
+from lottery import cache
+from models import User, Draw, ArchivedDraw, RoundJob, RoundJobShard
+
+# CONFIG
+# number of user draws loaded, settled and written back per transaction
+CHUNK_SIZE = 5000
+# processes settling one shard each, shared by every settlement in this worker
+executor = SpawnPool()
+# app of a shard settlement process, built from the config of the app that started it
+process_app = None
+
+# a draw with its owner's email and key (draws cannot be joined with the users of another database)
+OwnedDraw = namedtuple('OwnedDraw', ['id', 'user_id', 'numbers', 'email', 'key'])
+
+
+# summary of a settled lottery round
+class SettlementReport:
+
+    def __init__(self, lottery_round):
+        self.lottery_round = lottery_round
+        self.processed = 0
+        self.results = []
+        self.tiers = Counter()
+        self.elapsed = 0.0
+
+    # settlement throughput
+    @property
+    def tickets_per_second(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.processed / self.elapsed
+
+    # add the report of one shard
+    def merge(self, report):
+        self.processed += report.processed
+        self.results.extend(report.results)
+        self.tiers.update(report.tiers)
+
+
+# emails and keys of the owners of draws by user id
+def owners(user_ids):
+    query = select(User.id, User.email, User.key).where(User.id.in_(set(user_ids)))
+    return {row.id: row for row in db.session.execute(query)}
+
+
+# load one chunk of a shard's unplayed user draw ids, their match tokens and owners
+def load_chunk(shard, last_id, max_id, chunk_size):
+    query = select(Draw.id, Draw.match_token, Draw.user_id) \
+        .where(Draw.master_draw == False, Draw.been_played == False, Draw.id > last_id, Draw.id <= max_id) \
+        .order_by(Draw.id) \
+        .limit(chunk_size)
+
+    return shards.execute(shard, query).all()
+
+
+# load the unplayed draws of a chunk with their owner's email and key (only those without a match token
+# when untokened is set)
+def load_draws(shard, first_id, last_id, untokened=False):
+    query = select(Draw.id, Draw.user_id, Draw.numbers) \
+        .where(Draw.id.between(first_id, last_id), Draw.master_draw == False, Draw.been_played == False) \
+        .order_by(Draw.id)
+
+    if untokened:
+        query = query.where(Draw.match_token == None)
+
+    draws = shards.execute(shard, query).all()
+    owned_by = owners(draw.user_id for draw in draws)
+    return [OwnedDraw(draw.id, draw.user_id, draw.numbers, owned_by[draw.user_id].email, owned_by[draw.user_id].key)
+            for draw in draws]
+
+
+# find the winners of the round on a shard with one indexed lookup of the winning match token
+def token_winners(shard, winning_token, last_id, max_id):
+    query = select(Draw.id, Draw.user_id, Draw.numbers) \
+        .where(Draw.match_token == winning_token, Draw.master_draw == False, Draw.been_played == False,
+               Draw.id > last_id, Draw.id <= max_id) \
+        .order_by(Draw.id)
+
+    draws = shards.execute(shard, query).all()
+    owned_by = owners(draw.user_id for draw in draws)
+    return [OwnedDraw(draw.id, draw.user_id, draw.numbers, owned_by[draw.user_id].email, owned_by[draw.user_id].key)
+            for draw in draws]
+
+
+# find the jackpot winners of a chunk by match token (decrypting only draws without one)
+def settle_chunk(shard, rows, winning_ticket, winners_by_token, workers=1):
+    first_id, last_id = rows[0].id, rows[-1].id
+    numbers = models.format_numbers(winning_ticket)
+
+    # tokened draws won if the round's token lookup found them
+    winners = [(row.id, numbers, row.user_id, row.email)
+               for row in winners_by_token if first_id <= row.id <= last_id]
+
+    # draws without a token have to be decrypted and compared
+    if any(row.match_token is None for row in rows):
+        untokened = load_draws(shard, first_id, last_id, untokened=True)
+        decrypted = decryption.decrypt_draws(untokened, workers)
+
+        for row in untokened:
+            if decrypted[row.id] == winning_ticket:
+                winners.append((row.id, numbers, row.user_id, row.email))
+
+    return winners
+
+
+# decrypt every draw of a chunk and work out its matched count and prize tier
+# returns the jackpot winners and the per-draw updates of the draws matching at least one number
+def settle_chunk_tiers(shard, rows, winning_ticket, bonus, workers=1):
+    draws = load_draws(shard, rows[0].id, rows[-1].id)
+    decrypted = decryption.decrypt_draws(draws, workers)
+    counts, prize_tiers = tiers.match_tiers([decrypted[draw.id] for draw in draws], winning_ticket, bonus)
+
+    numbers = models.format_numbers(winning_ticket)
+    winners = []
+    updates = []
+
+    for draw, count, tier in zip(draws, counts.tolist(), prize_tiers):
+        if count:
+            updates.append({'id': draw.id, 'matched_count': count, 'tier': tier, 'matches_master': count == 6})
+        if count == 6:
+            winners.append((draw.id, numbers, draw.user_id, draw.email))
+
+    return winners, updates
+
+
+# write the chunk back with bulk updates and move it to the shard's archive (committed by the caller)
+def write_chunk(shard, first_id, last_id, winner_ids, updates, lottery_round):
+    # every unplayed user draw in the chunk's id range is now played in this round
+    shards.execute(
+        shard,
+        update(Draw)
+        .where(Draw.id.between(first_id, last_id), Draw.master_draw == False, Draw.been_played == False)
+        .values(been_played=True, lottery_round=lottery_round)
+        .execution_options(synchronize_session=False)
+    )
+
+    # write matched counts and tiers in one bulk update by primary key
+    if updates:
+        shards.update_by_id(shard, Draw, updates)
+
+    # otherwise flag the jackpot winners of the chunk
+    elif winner_ids:
+        shards.execute(
+            shard,
+            update(Draw)
+            .where(Draw.id.in_(winner_ids))
+            .values(matches_master=True, matched_count=6, tier=tiers.TIERS[0])
+            .execution_options(synchronize_session=False)
+        )
+
+    # the settled chunk leaves the live table, which only holds open tickets
+    models.archive_draws(Draw.id.between(first_id, last_id), Draw.master_draw == False, Draw.been_played == True,
+                         shard=shard)
+
+
+# number of winners in each prize tier of a round, counted on every shard
+def tier_counts(lottery_round):
+    query = select(ArchivedDraw.tier, func.count(ArchivedDraw.id)) \
+        .where(ArchivedDraw.lottery_round == lottery_round, ArchivedDraw.master_draw == False,
+               ArchivedDraw.tier != None) \
+        .group_by(ArchivedDraw.tier)
+
+    counts = Counter()
+    for rows in shards.scatter(query):
+        counts.update(dict(rows))
+    return {tier: counts.get(tier, 0) for tier in tiers.TIERS}
+
+
+# winners of a settled round on every shard as (round, numbers, user id, email)
+def round_winners(lottery_round):
+    query = select(ArchivedDraw.numbers, ArchivedDraw.user_id) \
+        .where(ArchivedDraw.lottery_round == lottery_round, ArchivedDraw.master_draw == False,
+               ArchivedDraw.matches_master == True) \
+        .order_by(ArchivedDraw.draw_id)
+
+    draws = [draw for rows in shards.scatter(query) for draw in rows]
+    owned_by = owners(draw.user_id for draw in draws)
+    return [(lottery_round,
+             models.format_numbers(models.parse_numbers(models.decrypt(draw.numbers, owned_by[draw.user_id].key))),
+             draw.user_id, owned_by[draw.user_id].email)
+            for draw in draws]
+
+
+# highest user draw id entered so far on a shard (the end of the round there)
+def max_draw_id(shard):
+    return shards.execute(
+        shard, select(func.max(Draw.id)).where(Draw.master_draw == False)
+    ).scalar() or 0
+
+
+# number of unplayed user draws of a shard up to an id
+def open_draws(shard, max_id):
+    return shards.execute(
+        shard, select(func.count(Draw.id))
+        .where(Draw.master_draw == False, Draw.been_played == False, Draw.id <= max_id)
+    ).scalar()
+
+
+# check whether any shard has an unplayed user draw
+def any_open_draws():
+    query = select(Draw.id).where(Draw.master_draw == False, Draw.been_played == False).limit(1)
+    return any(shards.scatter(query))
+
+
+# settle the unplayed user draws of one shard, one transaction per chunk, recording progress
+# in the job's row for the shard (and the job's totals, which every shard adds to)
+def settle_shard(shard, winning_ticket, bonus, lottery_round, job_id=None, chunk_size=CHUNK_SIZE, workers=1,
+                 prize_tiers=False):
+    report = SettlementReport(lottery_round)
+
+    # a job resumes after its last committed chunk and stops at the end of its round
+    progress = RoundJobShard.query.filter_by(job_id=job_id, shard=shard).first() if job_id else None
+    if progress:
+        last_id = progress.last_draw_id
+        max_id = progress.max_draw_id
+    else:
+        last_id = 0
+        max_id = max_draw_id(shard)
+
+    if not prize_tiers:
+        winners_by_token = token_winners(shard, models.match_token(winning_ticket), last_id, max_id)
+
+    while True:
+        rows = load_chunk(shard, last_id, max_id, chunk_size)
+        if not rows:
+            break
+
+        if prize_tiers:
+            winners, updates = settle_chunk_tiers(shard, rows, winning_ticket, bonus, workers)
+        else:
+            winners, updates = settle_chunk(shard, rows, winning_ticket, winners_by_token, workers), []
+        write_chunk(shard, rows[0].id, rows[-1].id, [winner[0] for winner in winners], updates, lottery_round)
+
+        for draw_id, numbers, user_id, email in winners:
+            report.results.append((lottery_round, numbers, user_id, email))
+        for draw_update in updates:
+            if draw_update['tier']:
+                report.tiers[draw_update['tier']] += 1
+
+        report.processed += len(rows)
+        last_id = rows[-1].id
+
+        # the chunk of another shard commits before the progress that skips it on resume: were the progress
+        # committed without it, a resumed job would leave the chunk's draws open for the next round. A resume after
+        # the chunk but before the progress finds the chunk's draws archived, so they are not settled twice
+        if shard != 0:
+            db.session.commit()
+
+        # record progress (in the chunk's transaction when the shard is the main database)
+        if progress:
+            progress.processed += len(rows)
+            progress.winners += len(winners)
+            progress.last_draw_id = last_id
+            db.session.execute(
+                update(RoundJob)
+                .where(RoundJob.id == job_id)
+                .values(processed=RoundJob.processed + len(rows), winners=RoundJob.winners + len(winners),
+                        updated_on=datetime.now())
+                .execution_options(synchronize_session=False)
+            )
+
+        db.session.commit()
+        # the owners' open tickets and results changed
+        cache.invalidate(row.user_id for row in rows)
+
+    return report
+
+
+# settle one shard in a settlement process, with an app built from the starting app's config
+def settle_shard_process(config, shard, *args):
+    global process_app
+
+    if process_app is None:
+        from app import create_app
+        process_app = create_app(config)
+
+    with process_app.app_context():
+        return settle_shard(shard, *args)
+
+
+# config of the current app that a settlement process can be sent (its plain values)
+def process_config():
+    return {name: value for name, value in current_app.config.items()
+            if isinstance(value, (str, bytes, int, float, bool, type(None)))}
+
+
+# settle every unplayed user draw against the winning draw, each shard in its own process when the draws
+# are sharded (with prize_tiers every draw is decrypted to count its matches, otherwise only jackpots are
+# found by token)
+def settle_round(winning_draw, job=None, chunk_size=CHUNK_SIZE, workers=1, prize_tiers=False):
+    report = SettlementReport(winning_draw.lottery_round)
+    start = time.perf_counter()
+
+    # the winning draw is encrypted with the key of the admin who created it
+    owner = db.session.get(User, winning_draw.user_id)
+    winning_ticket = models.parse_numbers(models.decrypt(winning_draw.numbers, owner.key))
+    bonus = int(models.decrypt(winning_draw.bonus, owner.key)) if winning_draw.bonus else None
+    args = (winning_ticket, bonus, report.lottery_round, job.id if job else None, chunk_size)
+
+    if shards.count() == 1:
+        report.merge(settle_shard(0, *args, workers, prize_tiers))
+    else:
+        # the decryption processes are shared out between the shards
+        config = process_config()
+        shard_workers = max(1, workers // shards.count())
+        pool = executor.get(shards.count())
+        futures = [pool.submit(settle_shard_process, config, shard, *args, shard_workers, prize_tiers)
+                   for shard in range(shards.count())]
+        for future in futures:
+            report.merge(future.result())
+
+    # mark the winning draw as played once every chunk is committed
+    winning_draw.been_played = True
+    if job:
+        job.status = 'finished'
+        job.updated_on = job.finished_on = datetime.now()
+    db.session.commit()
+    cache.invalidate([winning_draw.user_id])
+
+    report.elapsed = time.perf_counter() - start
+    return report
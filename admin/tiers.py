@@ -0,0 +1,49 @@
+# IMPORTS
+import models
+
+# numpy is imported by the functions below, so workers that never settle a round do not load it
+
+# CONFIG
+# prize tiers from the jackpot down
+TIERS = ('6', '5+bonus', '5', '4', '3')
+
+
+# number of set bits of each value in a uint64 array
+def popcount(values):
+    import numpy as np
+
+    # numpy 2 has a native popcount ufunc
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.uint8)
+
+    # otherwise count the bits of each byte
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1, dtype=np.uint8)
+
+
+# turn tickets into a uint64 array of ticket bitmasks
+def ticket_masks(tickets):
+    import numpy as np
+
+    return np.fromiter((models.ticket_mask(ticket) for ticket in tickets), dtype=np.uint64, count=len(tickets))
+
+
+# count the winning numbers of each ticket and its prize tier (None for no prize)
+def match_tiers(tickets, winning_ticket, bonus=None):
+    import numpy as np
+
+    masks = ticket_masks(tickets)
+    counts = popcount(masks & np.uint64(models.ticket_mask(winning_ticket)))
+
+    # 5 matches are upgraded when the ticket also holds the bonus number
+    if bonus is not None:
+        has_bonus = (masks & np.uint64(1 << bonus)) != 0
+    else:
+        has_bonus = np.zeros(len(tickets), dtype=bool)
+
+    tiers = np.select(
+        [counts == 6, (counts == 5) & has_bonus, counts == 5, counts == 4, counts == 3],
+        TIERS,
+        default='',
+    )
+
+    return counts, [tier or None for tier in tiers.tolist()]
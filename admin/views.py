@@ -3,15 +3,79 @@ import logging
 import random
 from datetime import datetime
 
-from flask import Blueprint, render_template, flash, redirect, url_for, request
-from flask_login import current_user
+from flask import Blueprint, render_template, flash, redirect, url_for, request, jsonify, abort, Response, \
+    stream_with_context
+from flask_login import current_user, login_required
 
+import etags
 import models
+import profiler
+from admin import export, jobs, logtail, settlement
 from app import db
-from models import User, Draw
+from lottery import cache
+from models import User, Draw, Round, RoundJob
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
+# most log entries shown on one page
+MAX_LOG_LINES = 500
+# users shown on one page by default, and at most
+USERS_PAGE_SIZE = 50
+MAX_USERS_PAGE_SIZE = 500
+# highest character, closing the range of emails starting with a prefix
+LAST_CHARACTER = '\U0010ffff'
+
+
+# one page of users with only the given columns (which must include id and email), in id order,
+# or in email order when searching by email prefix (?email=prefix&size=50&after=id or &after_email=email)
+# returns the rows and the query args of the next page (None on the last page)
+def user_page(columns, role=None):
+    size = min(max(request.args.get('size', USERS_PAGE_SIZE, type=int), 1), MAX_USERS_PAGE_SIZE)
+    prefix = request.args.get('email', '').strip()
+
+    query = db.select(*columns)
+    if role:
+        query = query.where(User.role == role)
+
+    if prefix:
+        # a range on the unique email index (SQLite cannot use the index for LIKE)
+        query = query.where(User.email >= prefix, User.email < prefix + LAST_CHARACTER)
+        after = request.args.get('after_email')
+        if after:
+            query = query.where(User.email > after)
+        query = query.order_by(User.email)
+    else:
+        query = query.where(User.id > request.args.get('after', 0, type=int)).order_by(User.id)
+
+    # one extra row tells whether there is a next page
+    rows = db.session.execute(query.limit(size + 1)).all()
+
+    following = None
+    if len(rows) > size:
+        rows = rows[:size]
+        if prefix:
+            following = {'size': size, 'email': prefix, 'after_email': rows[-1].email}
+        else:
+            following = {'size': size, 'after': rows[-1].id}
+
+    return rows, following
+
+
+# log an attempt by a user who is not an admin to use admin functionality, and show the forbidden page
+def restricted_access():
+    logging.warning('User [%s, id: %s, role: %s, %s] tried to access restricted functionality on [%s]',
+                    current_user.email,
+                    current_user.id,
+                    current_user.role,
+                    request.remote_addr,
+                    datetime.now(),
+                    extra={'event': 'restricted_access',
+                           'user': current_user.email,
+                           'user_id': current_user.id,
+                           'role': current_user.role,
+                           'ip': request.remote_addr})
+
+    return render_template('errors/403.html'), 403
 
 
 # VIEWS
@@ -25,56 +89,80 @@ def admin():
 @admin_blueprint.route('/generate_winning_draw')
 def generate_winning_draw():
 
-    # get current winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True).first()
+    # get current round and its winning draw
+    current_round = models.current_round()
     lottery_round = 1
 
-    # if a current winning draw exists
-    if current_winning_draw:
+    # if a current round exists
+    if current_round:
         # update lottery round by 1
-        lottery_round = current_winning_draw.lottery_round + 1
-
-        # delete current winning draw
-        db.session.delete(current_winning_draw)
-        db.session.commit()
+        lottery_round = current_round.id + 1
+
+        # if a current winning draw exists
+        current_winning_draw = current_round.master_draw
+        if current_winning_draw:
+            # a round being settled cannot be replaced
+            job = RoundJob.query.filter_by(master_draw_id=current_winning_draw.id).order_by(RoundJob.id.desc()).first()
+            if job and jobs.is_active(job):
+                flash("Round %s is still being settled." % current_round.id)
+                return redirect(url_for('admin.admin'))
+
+            # move the current winning draw to the archive
+            owner_id = current_winning_draw.user_id
+            current_round.master_draw_id = None
+            db.session.flush()
+            models.archive_draws(Draw.id == current_winning_draw.id)
+            db.session.commit()
+            cache.invalidate([owner_id])
 
-    # get new winning numbers for draw
-    winning_numbers = random.sample(range(1, 60), 6)
+    # get new winning numbers and bonus number for draw
+    winning_numbers = random.sample(range(1, 60), 7)
+    bonus_number = winning_numbers.pop()
     winning_numbers.sort()
-    winning_numbers_string = ''
-    for i in range(6):
-        winning_numbers_string += str(winning_numbers[i]) + ' '
-    winning_numbers_string = winning_numbers_string[:-1]
+    winning_numbers_string = models.format_numbers(winning_numbers)
 
     # encrypt the winning numbers
     encrypted_numbers = models.encrypt(winning_numbers_string, current_user.key)
 
     # create a new draw object.
-    new_winning_draw = Draw(user_id=current_user.id, numbers=encrypted_numbers, master_draw=True, lottery_round=lottery_round)
+    new_winning_draw = Draw(user_id=current_user.id, numbers=encrypted_numbers, master_draw=True, lottery_round=lottery_round,
+                            match_token=models.match_token(winning_numbers),
+                            bonus=models.encrypt(str(bonus_number), current_user.key))
 
-    # add the new winning draw to the database
+    # add the new winning draw and its round to the database
     db.session.add(new_winning_draw)
+    db.session.flush()
+    db.session.add(Round(id=lottery_round, master_draw_id=new_winning_draw.id))
     db.session.commit()
+    cache.invalidate([current_user.id])
 
     # re-render admin page
-    flash("New winning draw %s added." % winning_numbers_string)
+    flash("New winning draw %s (bonus %s) added." % (winning_numbers_string, bonus_number))
     return redirect(url_for('admin.admin'))
 
 
-# view current winning draw
+# view current winning draw (a conditional GET: 304 until the winning draw changes)
 @admin_blueprint.route('/view_winning_draw')
 def view_winning_draw():
 
-    # get winning draw from DB
-    current_winning_draw = Draw.query.filter_by(master_draw=True,been_played=False).first()
+    # get winning draw of the current round from DB
+    current_winning_draw = models.current_master_draw()
 
-    # if a winning draw exists
-    if current_winning_draw:
-        decrypted = models.decrypt(current_winning_draw.numbers, current_user.key)
-        current_winning_draw.numbers = decrypted
+    # if an unplayed winning draw exists
+    if current_winning_draw and not current_winning_draw.been_played:
+        def render():
+            # decrypt the numbers for display (without changing the draw itself)
+            winning_draw = {'lottery_round': current_winning_draw.lottery_round,
+                            'numbers': models.decrypt(current_winning_draw.numbers, current_user.key),
+                            'bonus': models.decrypt(current_winning_draw.bonus, current_user.key)
+                            if current_winning_draw.bonus else None}
 
-        # re-render admin page with current winning draw and lottery round
-        return render_template('admin/admin.html', winning_draw=current_winning_draw, name=current_user.firstname)
+            # re-render admin page with current winning draw and lottery round
+            return render_template('admin/admin.html', winning_draw=winning_draw, name=current_user.firstname)
+
+        # a new winning draw has a new id, and a played one is no longer shown
+        return etags.conditional(('view_winning_draw', current_user.id, current_winning_draw.lottery_round,
+                                  current_winning_draw.id), render)
 
     # if no winning draw exists, rerender admin page
     flash("No valid winning draw exists. Please add new winning draw.")
@@ -85,103 +173,131 @@ def view_winning_draw():
 @admin_blueprint.route('/run_lottery')
 def run_lottery():
 
-    # get current unplayed winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
+    # get winning draw of the current round
+    current_winning_draw = models.current_master_draw()
 
     # if current unplayed winning draw exists
-    if current_winning_draw:
+    if current_winning_draw and not current_winning_draw.been_played:
 
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-        results = []
+        # if the round is already being settled or at least one unplayed user draw exists
+        if RoundJob.query.filter_by(master_draw_id=current_winning_draw.id).first() or settlement.any_open_draws():
 
-        # if at least one unplayed user draw exists
-        if user_draws:
+            # settle the round in the background (or resume an interrupted settlement)
+            job = jobs.start_job(current_winning_draw)
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+            flash("Settlement job %s for round %s is %s." % (job.id, job.lottery_round, job.status))
+            return render_template('admin/admin.html', job=job, name=current_user.firstname)
 
-            # for each unplayed user draw
-            for draw in user_draws:
+        flash("No user draws entered.")
+        return admin()
 
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
+    # if current unplayed winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
 
-                # if user draw matches current unplayed winning draw
-                if models.decrypt(draw.numbers, user.key) == current_winning_draw.numbers:
+    # show the winners and prize tiers of the last settled round
+    job = RoundJob.query.filter_by(status='finished').order_by(RoundJob.id.desc()).first()
+    if job:
+        status = jobs.job_status(job)
 
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, models.decrypt(draw.numbers), draw.user_id, user.email))
+        # if no winners
+        if not status['results']:
+            flash("No winners.")
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
+        return render_template('admin/admin.html', job=job, results=status['results'], tiers=status['tiers'],
+                               name=current_user.firstname)
 
-                # update draw as played
-                draw.been_played = True
+    return redirect(url_for('admin.admin'))
 
-                # decrypt draw numbers
-                decrypted = models.decrypt(draw.numbers, user.key)
-                draw.numbers = decrypted
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+# view the progress of a settlement job
+@admin_blueprint.route('/run_lottery/status/<int:job_id>')
+@login_required
+def run_lottery_status(job_id):
+    # a finished job lists the winners' emails: admins only
+    if current_user.role != 'admin':
+        return restricted_access()
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
+    job = db.session.get(RoundJob, job_id)
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
+    # if the job does not exist
+    if not job:
+        abort(404)
 
-            return render_template('admin/admin.html', results=results, name=current_user.firstname)
+    return jsonify(jobs.job_status(job))
 
-        flash("No user draws entered.")
-        return admin()
 
-    # if current unplayed winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
-    return redirect(url_for('admin.admin'))
+# download the settled draws of a round as gzipped CSV or JSON lines (?format=jsonl&winners=1 for prize winners only)
+@admin_blueprint.route('/export/<int:lottery_round>')
+@login_required
+def export_round(lottery_round):
+    # every player's email and numbers: admins only
+    if current_user.role != 'admin':
+        return restricted_access()
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        abort(400)
+    winners_only = request.args.get('winners') == '1'
+
+    filename = 'round-%s%s.%s.gz' % (lottery_round, '-winners' if winners_only else '', export_format)
+    # streamed as it is read and compressed, keeping the request context open for the database cursor
+    return Response(stream_with_context(export.export_round(lottery_round, export_format, winners_only)),
+                    mimetype='application/gzip',
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+# view the SQL statements of the latest requests (when QUERY_PROFILER is set)
+@admin_blueprint.route('/query_profile')
+@login_required
+def query_profile():
+    # the SQL of other users' requests: admins only
+    if current_user.role != 'admin':
+        return restricted_access()
+
+    return jsonify(profiler.recent_profiles())
 
 
 # view all registered users
 @admin_blueprint.route('/view_all_users')
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
+    current_users, following = user_page((User.id, User.email, User.firstname, User.lastname, User.phone, User.role),
+                                         role='user')
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users)
+    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users,
+                           current_users_next=following, users_email=request.args.get('email', ''))
 
 
-# view last 10 log entries
+# view the last log entries (?lines=10&level=WARNING&user=email&before=offset for older entries)
 @admin_blueprint.route('/logs')
+@login_required
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    # other users' emails, addresses and security events: admins only
+    if current_user.role != 'admin':
+        return restricted_access()
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+    count = min(max(request.args.get('lines', 10, type=int), 1), MAX_LOG_LINES)
+    before = request.args.get('before', type=int)
+    level = request.args.get('level')
+    user = request.args.get('user')
+
+    # read backwards from the end of the file (or from the previous page)
+    content, older = logtail.tail('lottery.log', count, before, logtail.matches(level, user))
+
+    return render_template('admin/admin.html', logs=[logtail.display(line) for line in content], name=current_user.firstname,
+                           logs_older=older, logs_args={'lines': count, 'level': level, 'user': user})
 
 
 # view every user activity
 @admin_blueprint.route('/view_user_activity')
 def view_user_activity():
     if current_user.role != 'admin':
-        # log restricted access
-        logging.warning('User [%s, id: %s, role: %s, %s] tried to access restricted functionality on [%s]',
-                        current_user.email,
-                        current_user.id,
-                        current_user.role,
-                        request.remote_addr,
-                        datetime.now())
-
-        return render_template('errors/403.html')
+        return restricted_access()
 
-    current_users = User.query.all()
+    current_users, following = user_page((User.id, User.email, User.registered_on, User.current_login,
+                                          User.last_login, User.role))
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_users2=current_users)
+    return render_template('admin/admin.html', name=current_user.firstname, current_users2=current_users,
+                           current_users2_next=following, activity_email=request.args.get('email', ''))
 
 
 
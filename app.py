@@ -3,97 +3,217 @@ import logging
 
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
-from flask_qrcode import QRcode
 from flask_login import LoginManager
 import os
 from dotenv import load_dotenv
 from flask_talisman import Talisman
+from sqlalchemy import event
+
+import audit
+import metrics
+import profiler
 
-# configure the logger class in the lottery.log file
-logger = logging.getLogger()
-file_handler = logging.FileHandler('lottery.log', 'a')
-file_handler.setLevel(logging.WARNING)
-logger.addHandler(file_handler)
 # load dotenv reader
 load_dotenv()
 
-# CONFIG
-app = Flask(__name__)
-# get the secret key from .env file
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# get the recaptcha keys from .env file
-app.config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
-app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
-
+# configure the logger class: records are queued and written to lottery.log as JSON lines by a background thread
+# (logging belongs to the process, so it is set up once on import rather than per app). Every worker appends to
+# the same file, rotating it in turn under a lock; dropped records are logged and counted on /metrics
+logger = logging.getLogger()
+audit_handler, audit_listener = audit.setup(logger, 'lottery.log',
+                                            queue_size=int(os.getenv('AUDIT_QUEUE_SIZE', 10000)),
+                                            max_bytes=int(os.getenv('AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+                                            backups=int(os.getenv('AUDIT_LOG_BACKUPS', 5)),
+                                            on_dropped=metrics.log_records_dropped)
+
+# extensions, bound to an app by create_app
+db = SQLAlchemy()
+login_manager = LoginManager()
 
-# initialise database
-db = SQLAlchemy(app)
 
-# configure the qrcode class
-qrcode = QRcode(app)
+# get the config from the environment (.env file)
+def load_config(app):
+    # get the secret key from .env file
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
+    # log every SQL statement (debugging only)
+    app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO', '0') == '1'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # get the recaptcha keys from .env file
+    app.config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
+    app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
+    # check the login reCAPTCHA (RECAPTCHA_ENABLED=0 only for load tests against a local server)
+    app.config['RECAPTCHA_ENABLED'] = os.getenv('RECAPTCHA_ENABLED', '1') == '1'
+    # key of the ticket match tokens, required and kept out of .env: there are few enough tickets to hash them
+    # all, so anyone with the key can read every ticket from its token (changing it invalidates open draws' tokens)
+    app.config['MATCH_TOKEN_KEY'] = os.getenv('MATCH_TOKEN_KEY')
+    # settle prize tiers (match 3/4/5/5+bonus/6); off settles jackpots only, without decrypting tokened draws
+    app.config['PRIZE_TIERS'] = os.getenv('PRIZE_TIERS', '1') == '1'
+    # number of per-user Fernet objects kept for encrypting and decrypting draws
+    app.config['CIPHER_CACHE_SIZE'] = int(os.getenv('CIPHER_CACHE_SIZE', 10000))
+    # cache logged in users between requests for USER_CACHE_TTL seconds
+    app.config['USER_CACHE'] = os.getenv('USER_CACHE', '1') == '1'
+    app.config['USER_CACHE_TTL'] = float(os.getenv('USER_CACHE_TTL', 30))
+    # bcrypt cost and the pool hashing passwords (requests beyond workers + queue depth get a 503)
+    app.config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', 12))
+    app.config['BCRYPT_WORKERS'] = int(os.getenv('BCRYPT_WORKERS', 2))
+    app.config['BCRYPT_QUEUE_DEPTH'] = int(os.getenv('BCRYPT_QUEUE_DEPTH', 8))
+    # number of processes decrypting tickets during settlement (1 = decrypt in the settlement thread)
+    app.config['SETTLEMENT_WORKERS'] = int(os.getenv('SETTLEMENT_WORKERS', os.cpu_count() or 1))
+    # count and time the SQL statements of each request (X-Query-* response headers and /query_profile)
+    app.config['QUERY_PROFILER'] = os.getenv('QUERY_PROFILER', '0') == '1'
+    # times one statement may run in a request before it is flagged as a possible N+1 query
+    app.config['QUERY_PROFILER_N_PLUS_ONE'] = int(os.getenv('QUERY_PROFILER_N_PLUS_ONE', 10))
+    # cache decrypted open tickets and results per user in a file shared by the workers
+    app.config['DRAW_CACHE'] = os.getenv('DRAW_CACHE', '1') == '1'
+    # cache file (by default a file in /dev/shm named after the database) and its size cap
+    app.config['DRAW_CACHE_PATH'] = os.getenv('DRAW_CACHE_PATH')
+    app.config['DRAW_CACHE_MAX_BYTES'] = int(os.getenv('DRAW_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    # SQLite pragmas set on every new connection (SQLITE_PRAGMAS=0 keeps the SQLite defaults)
+    app.config['SQLITE_PRAGMAS'] = os.getenv('SQLITE_PRAGMAS', '1') == '1'
+    # milliseconds a connection waits for the write lock before failing with "database is locked"
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+    # bytes of the database file read through a memory map
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    # KiB of page cache per connection
+    app.config['SQLITE_CACHE_SIZE'] = int(os.getenv('SQLITE_CACHE_SIZE', 64 * 1024))
+    # connections kept open per worker, and the extra ones opened under load
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    # seconds a request waits for a free connection
+    app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', 30))
+    # per endpoint request counts, latencies, SQL statements and crypto time of all workers on /metrics
+    app.config['METRICS'] = os.getenv('METRICS', '1') == '1'
+    # number of databases the user draws are spread over by owner (1 = every draw in the main database)
+    app.config['DRAW_SHARDS'] = int(os.getenv('DRAW_SHARDS', 1))
+    # URI of draw shard n >= 1 with %s for n (by default a file next to the main database, e.g. lottery-draws-1.db)
+    app.config['DRAW_SHARD_URI'] = os.getenv('DRAW_SHARD_URI')
+
+
+# tune the new SQLite connections of an app: WAL lets readers run during the long settlement writes, and
+# synchronous=NORMAL only syncs at checkpoints (a power loss can lose the last commits, never corrupt the file)
+def sqlite_pragmas(config):
+    def set_sqlite_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+        cursor.execute('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+        # a negative cache size is in KiB rather than pages
+        cursor.execute('PRAGMA cache_size=%d' % -config['SQLITE_CACHE_SIZE'])
+        cursor.close()
+
+    return set_sqlite_pragmas
+
+
+# QR code image (data URI) for the 2FA setup page: flask_qrcode loads qrcode and Pillow,
+# so it is only imported when the first one is rendered
+def qrcode(data, **kwargs):
+    from flask_qrcode import QRcode
+
+    return QRcode.qrcode(data, **kwargs)
 
 
 # ERROR VIEWS
-@app.errorhandler(400)
 def bad_request(error):
     return render_template('errors/400.html'), 400
 
 
-@app.errorhandler(403)
-def bad_request(error):
+def forbidden(error):
     return render_template('errors/403.html'), 403
 
 
-@app.errorhandler(404)
-def bad_request(error):
+def not_found(error):
     return render_template('errors/404.html'), 404
 
 
-@app.errorhandler(500)
-def bad_request(error):
+def internal_error(error):
     return render_template('errors/500.html'), 500
 
 
-@app.errorhandler(503)
-def bad_request(error):
+def unavailable(error):
     return render_template('errors/503.html'), 503
 
 
 # HOME PAGE VIEW
-@app.route('/')
 def index():
     return render_template('main/index.html')
 
 
-# BLUEPRINTS
-# import blueprints
-from users.views import users_blueprint
-from admin.views import admin_blueprint
-from lottery.views import lottery_blueprint
+# load the user by id (flask_login keeps it for the rest of the request)
+@login_manager.user_loader
+def load_user(id):
+    from users import cache
 
+    return cache.load_user(int(id))
 
-#  register blueprints with app
-app.register_blueprint(users_blueprint)
-app.register_blueprint(admin_blueprint)
-app.register_blueprint(lottery_blueprint)
 
-# set up the login manager class
-login_manager = LoginManager()
-login_manager.login_view = 'users.login'
-login_manager.init_app(app)
+# build the app: config from the environment (overridden by config), extensions, views and blueprints.
+# Nothing here starts a thread or opens a connection, so gunicorn can build it in the master (--preload)
+def create_app(config=None):
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
 
-from models import User
+    # refuse to start without a match token key of its own
+    if not app.config['MATCH_TOKEN_KEY'] or app.config['MATCH_TOKEN_KEY'] == app.config['SECRET_KEY']:
+        raise RuntimeError('MATCH_TOKEN_KEY must be set in the environment to a secret key other than SECRET_KEY, '
+                           'e.g. python -c "import secrets; print(secrets.token_hex(32))"')
 
+    # an in-memory database keeps its single shared connection
+    if ':memory:' not in (app.config['SQLALCHEMY_DATABASE_URI'] or ''):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': app.config['DB_POOL_SIZE'],
+            'max_overflow': app.config['DB_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        }
 
-# load the user by id
-@login_manager.user_loader
-def load_user(id):
-    return User.query.get(int(id))
+    # the databases of the draw shards are extra binds
+    import shards
+    shards.configure(app)
+
+    # initialise database
+    db.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if app.config['SQLITE_PRAGMAS'] and engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', sqlite_pragmas(app.config))
+
+    # profile the SQL statements of each request (when QUERY_PROFILER is set)
+    profiler.init_app(app, db)
+    # record request metrics and serve /metrics (when METRICS is set)
+    metrics.init_app(app, db)
+
+    # qrcode(uri) in templates
+    app.add_template_global(qrcode, 'qrcode')
+
+    app.register_error_handler(400, bad_request)
+    app.register_error_handler(403, forbidden)
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(500, internal_error)
+    app.register_error_handler(503, unavailable)
+    app.add_url_rule('/', 'index', index)
+
+    # BLUEPRINTS
+    # import blueprints (they import the models, which need db defined above)
+    from users.views import users_blueprint
+    from admin.views import admin_blueprint
+    from lottery.views import lottery_blueprint
+
+    #  register blueprints with app
+    app.register_blueprint(users_blueprint)
+    app.register_blueprint(admin_blueprint)
+    app.register_blueprint(lottery_blueprint)
+
+    # set up the login manager class
+    login_manager.login_view = 'users.login'
+    login_manager.init_app(app)
+
+    return app
 
 
 if __name__ == "__main__":
     # run app with the self-signed certificates
-    app.run()
+    create_app().run()
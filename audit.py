@@ -0,0 +1,198 @@
+# IMPORTS
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, WatchedFileHandler
+
+# CONFIG
+# structured fields copied from a record's extra={...} into its JSON line
+FIELDS = ('event', 'user', 'user_id', 'role', 'ip')
+# most records written (and flushed) together
+BATCH_SIZE = 100
+
+
+# format records as one JSON object per line
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(sep=' ', timespec='milliseconds'),
+            'level': record.levelname,
+        }
+
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value if isinstance(value, (int, float, bool)) else str(value)
+
+        # the queue handler has already merged the arguments and any traceback into the message
+        entry['message'] = record.getMessage()
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# queue handler that never blocks the request: records are dropped (and counted) when the queue is full
+class DroppingQueueHandler(QueueHandler):
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# file handler that writes a batch of records with a single flush, shared by every process of the server
+# (gunicorn workers): batches are written under a lock on path.lock, the process holding it rotates the file
+# once it passes max_bytes, and the others reopen the new file (WatchedFileHandler) before writing
+class BatchFileHandler(WatchedFileHandler):
+
+    def __init__(self, path, max_bytes=0, backups=0):
+        super().__init__(path, 'a', encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock_file = None
+        self.lock_pid = None
+
+    # lock the file against the other processes (a forked process opens the lock file again,
+    # as flock locks are shared by the processes holding the same open file)
+    def lock_processes(self):
+        if self.lock_pid != os.getpid():
+            self.lock_file = open(self.baseFilename + '.lock', 'a')
+            self.lock_pid = os.getpid()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def unlock_processes(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    # move path to path.1 (path.1 to path.2 and so on, dropping the oldest) and start a new file
+    def rotate(self):
+        self.stream.close()
+        self.stream = None
+
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%s' % (self.baseFilename, n)):
+                os.replace('%s.%s' % (self.baseFilename, n), '%s.%s' % (self.baseFilename, n + 1))
+        os.replace(self.baseFilename, self.baseFilename + '.1')
+
+        self.stream = self._open()
+        self._statstream()
+
+    def handle_batch(self, records):
+        self.acquire()
+        try:
+            self.lock_processes()
+            try:
+                # another process may have rotated the file since the last batch
+                self.reopenIfNeeded()
+                if self.stream is None:
+                    self.stream = self._open()
+                    self._statstream()
+
+                self.stream.write(''.join(self.format(record) + self.terminator for record in records))
+                self.stream.flush()
+
+                # the size of the file written by every process, not just this one's share
+                if self.max_bytes and self.backups and os.fstat(self.stream.fileno()).st_size >= self.max_bytes:
+                    self.rotate()
+            finally:
+                self.unlock_processes()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+# background thread writing queued records in batches (like logging.handlers.QueueListener)
+class BatchListener:
+
+    def __init__(self, records, handler, source, on_dropped=None, batch_size=BATCH_SIZE):
+        self.queue = records
+        self.handler = handler
+        # the queue handler, whose dropped records are logged (and passed to on_dropped) after each batch
+        self.source = source
+        self.on_dropped = on_dropped
+        self.reported = 0
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor, name='audit-log', daemon=True)
+        self.thread.start()
+
+    # write what is queued and stop the thread
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def monitor(self):
+        while True:
+            # wait for a record, then take whatever else is already queued
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            records = [record for record in batch if record is not None]
+            if records:
+                self.handler.handle_batch(records)
+                self.report_dropped()
+            if stop:
+                return
+
+    # log the number of records dropped since the last report (the queue has room again)
+    def report_dropped(self):
+        dropped = self.source.dropped - self.reported
+        if not dropped:
+            return
+
+        self.reported += dropped
+        record = logging.makeLogRecord({'name': 'audit', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                        'msg': 'Dropped %s log records: the log queue was full', 'args': (dropped,),
+                                        'event': 'log_records_dropped'})
+        self.handler.handle_batch([record])
+        if self.on_dropped:
+            self.on_dropped(dropped)
+
+
+# send the records of a logger through a bounded queue to a background writer of JSON lines
+# (on_dropped(count) is called with the number of records dropped while the queue was full)
+def setup(logger, path, level=logging.WARNING, queue_size=10000, max_bytes=10 * 1024 * 1024, backups=5,
+          on_dropped=None):
+    records = queue.Queue(queue_size)
+
+    file_handler = BatchFileHandler(path, max_bytes=max_bytes, backups=backups)
+    file_handler.setFormatter(JsonFormatter())
+
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.setLevel(level)
+    logger.addHandler(queue_handler)
+
+    listener = BatchListener(records, file_handler, queue_handler, on_dropped)
+    listener.start()
+    # write the queued records on shutdown
+    atexit.register(listener.stop)
+
+    # a forked process (a gunicorn worker of a preloaded app) inherits the queue but not the thread:
+    # give it a queue and writer thread of its own
+    def restart_in_child():
+        queue_handler.queue = listener.queue = queue.Queue(queue_size)
+        listener.thread = None
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_in_child)
+
+    return queue_handler, listener
@@ -0,0 +1,126 @@
+# IMPORTS
+import statistics
+import threading
+import time
+
+# seeds (and selects) the benchmark database, so it is imported before the app
+from benchmarks import seed
+from benchmarks.scenarios import client_for
+
+from app import db
+import models
+from admin import jobs
+from lottery import bulk
+from models import User, RoundJob
+
+# CONFIG
+# the app measured
+app = seed.app
+# users entering tickets, and the tickets each enters before the round is settled
+USERS = 20
+TICKETS_PER_USER = 5000
+# threads submitting tickets at the same time (like concurrent gunicorn workers), and tickets per submission
+SUBMITTERS = 8
+TICKETS_PER_SUBMISSION = 10
+# seconds of submissions measured while no settlement runs
+IDLE_SECONDS = 5
+
+
+# create the admin and the users with their tickets, returning the admin's and the users' ids
+def populate():
+    users = seed.seed(USERS, USERS * TICKETS_PER_USER)
+
+    with app.app_context():
+        admin = User.query.filter_by(role='admin').first()
+        return admin.id, [user.id for user in users]
+
+
+# submit tickets as one user until stop is set, recording the latency and status of every submission
+def submit(user_id, stop, latencies, errors):
+    client = client_for(user_id)
+
+    while not stop.is_set():
+        draws = [list(ticket) for ticket in bulk.quick_picks(TICKETS_PER_SUBMISSION)]
+        start = time.perf_counter()
+        response = client.post('/create_draws', json={'draws': draws})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+# run the submitters until until() returns, returning the submissions/second, latency percentiles and errors
+def measure(user_ids, until):
+    stop = threading.Event()
+    latencies = []
+    errors = []
+
+    threads = [threading.Thread(target=submit, args=(user_ids[i % len(user_ids)], stop, latencies, errors))
+               for i in range(SUBMITTERS)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    until()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    return {
+        'elapsed': elapsed,
+        'submissions': len(latencies) / elapsed,
+        'tickets': len(latencies) * TICKETS_PER_SUBMISSION / elapsed,
+        'p50': percentiles[49] * 1000,
+        'p99': percentiles[98] * 1000,
+        'errors': len(errors),
+    }
+
+
+# generate a winning draw, start settling the round and wait for the job to finish
+def settle(admin_id):
+    client_for(admin_id).get('/generate_winning_draw')
+
+    with app.app_context():
+        job_id = jobs.start_job(models.current_master_draw()).id
+
+    def until():
+        while True:
+            with app.app_context():
+                job = db.session.get(RoundJob, job_id)
+                if job.status in ('finished', 'failed'):
+                    return
+            time.sleep(0.05)
+
+    return job_id, until
+
+
+def main():
+    # statement logging would dominate the timings
+    with app.app_context():
+        db.engine.echo = False
+        journal_mode = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+
+    admin_id, user_ids = populate()
+    print('journal_mode=%s, %s tickets seeded, %s submitters x %s tickets' % (journal_mode, USERS * TICKETS_PER_USER,
+                                                                             SUBMITTERS, TICKETS_PER_SUBMISSION))
+
+    idle = measure(user_ids, lambda: time.sleep(IDLE_SECONDS))
+
+    job_id, until = settle(admin_id)
+    busy = measure(user_ids, until)
+
+    with app.app_context():
+        job = db.session.get(RoundJob, job_id)
+        settled = '%s: %s tickets in %.2fs' % (job.status, job.processed, (job.finished_on - job.created_on).total_seconds()) \
+            if job.finished_on else job.status
+
+    print('%-12s %10s %12s %10s %10s %8s' % ('phase', 'subs/s', 'tickets/s', 'p50 ms', 'p99 ms', 'errors'))
+    for phase, result in (('idle', idle), ('settlement', busy)):
+        print('%-12s %10.1f %12.1f %10.1f %10.1f %8d' % (phase, result['submissions'], result['tickets'],
+                                                         result['p50'], result['p99'], result['errors']))
+    print('settlement %s' % settled)
+
+
+if __name__ == '__main__':
+    main()
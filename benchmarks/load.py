@@ -0,0 +1,309 @@
+# IMPORTS
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+# seeds (and selects) the benchmark database, so it is imported before the app
+from benchmarks import seed, scenarios
+
+import pyotp
+
+# CONFIG
+# default share of the requests a session makes after logging in
+MIX = {'create_draw': 60, 'check_draws': 30, 'view_draws': 10}
+# status each request should answer with
+EXPECTED = {'login': 302, 'create_draw': 302, 'check_draws': 200, 'view_draws': 200, 'logout': 302}
+# directory holding app.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds allowed for gunicorn to start answering
+STARTUP_TIMEOUT = 30
+# seconds a single request may take
+REQUEST_TIMEOUT = 30
+
+
+# hand redirects back to the caller instead of following them
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+# latencies and errors of every route, shared by the session threads
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route, status, elapsed):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.statuses[route][status] += 1
+            if status != EXPECTED[route]:
+                self.errors[route] += 1
+
+    # throughput, error rate and latency percentiles per route
+    def report(self, duration):
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 \
+                else [latencies[0]] * 99
+            routes[route] = {
+                'requests': len(latencies),
+                'errors': self.errors[route],
+                'error_rate': round(self.errors[route] / len(latencies), 4),
+                'requests_per_sec': round(len(latencies) / duration, 1),
+                'p50_ms': round(percentiles[49] * 1000, 1),
+                'p90_ms': round(percentiles[89] * 1000, 1),
+                'p99_ms': round(percentiles[98] * 1000, 1),
+                'statuses': {str(status): count for status, count in sorted(self.statuses[route].items())},
+            }
+        return routes
+
+
+# one browser session of a seeded user: its own cookies and CSRF token
+class Session:
+
+    def __init__(self, base_url, stats):
+        self.base_url = base_url
+        self.stats = stats
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect())
+
+    # make a request, returning its status and body (status 0 when the connection failed)
+    def request(self, path, data=None):
+        body = urllib.parse.urlencode(data).encode('utf-8') if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body)
+
+        try:
+            with self.opener.open(req, timeout=REQUEST_TIMEOUT) as response:
+                return response.status, response.read().decode('utf-8', errors='replace')
+        except urllib.error.HTTPError as error:
+            return error.code, error.read().decode('utf-8', errors='replace')
+        except (OSError, urllib.error.URLError):
+            return 0, ''
+
+    # make a request and record it under a route
+    def timed(self, route, path, data=None):
+        start = time.perf_counter()
+        status, body = self.request(path, data)
+        self.stats.record(route, status, time.perf_counter() - start)
+        return status, body
+
+    # log in through the form with a fresh CSRF token and TOTP pin
+    def login(self, n, user):
+        status, body = self.request('/login')
+        if status != 200:
+            return False
+
+        status, body = self.timed('login', '/login', {'email': seed.user_email(n),
+                                                      'password': seed.PASSWORD,
+                                                      'pin': pyotp.TOTP(user.pin_key).now(),
+                                                      'csrf_token': scenarios.csrf_token_of(body)})
+        if status != 302:
+            return False
+
+        # an empty draw form fails validation and is rendered again with the session's token
+        status, body = self.request('/create_draw', {})
+        self.token = scenarios.csrf_token_of(body)
+        return self.token is not None
+
+    def create_draw(self, rng):
+        data = {'number%s' % (n + 1): number for n, number in enumerate(seed.random_ticket(rng))}
+        data['csrf_token'] = self.token
+        self.timed('create_draw', '/create_draw', data)
+
+    def check_draws(self, rng):
+        self.timed('check_draws', '/check_draws')
+
+    def view_draws(self, rng):
+        self.timed('view_draws', '/view_draws', {})
+
+    def logout(self):
+        self.timed('logout', '/logout')
+
+
+# log in as users in turn and make session_length requests of the mix, until stop is set
+def run_sessions(number, sessions, users, base_url, mix, session_length, stats, stop):
+    rng = random.Random(number)
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    n = number
+
+    while not stop.is_set():
+        session = Session(base_url, stats)
+        user = users[n % len(users)]
+
+        if session.login(n % len(users), user):
+            for route in rng.choices(routes, weights, k=session_length):
+                if stop.is_set():
+                    break
+                getattr(session, route)(rng)
+            session.logout()
+
+        # the next session of this thread logs in as another user
+        n += sessions
+
+
+# a free local port
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# start the app under gunicorn on the seeded database, waiting until it answers
+def start_gunicorn(port, workers, threads, log_dir, preload=False):
+    # the workers share the seeded database (SQLALCHEMY_DATABASE_URI is already set by the seeding tool)
+    env = dict(os.environ)
+    env.update({
+        # the login form skips reCAPTCHA, and hashes stay at the seeded cost instead of being upgraded
+        'RECAPTCHA_ENABLED': '0',
+        'BCRYPT_ROUNDS': str(seed.BCRYPT_ROUNDS),
+    })
+
+    log = open(os.path.join(log_dir, 'gunicorn.log'), 'w')
+    command = [sys.executable, '-m', 'gunicorn',
+               '--pythonpath', ROOT,
+               '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+               '--workers', str(workers),
+               '--threads', str(threads),
+               '--bind', '127.0.0.1:%s' % port]
+    # build the app once in the master and fork the workers from it
+    if preload:
+        command.append('--preload')
+
+    # run from the log directory, so the audit log of the run does not go into the repository
+    process = subprocess.Popen(command + ['app:create_app()'],
+                               cwd=log_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited, see %s' % log.name)
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%s/login' % port, timeout=1).close()
+            return process
+        except (OSError, urllib.error.URLError):
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError('gunicorn did not start within %ss, see %s' % (STARTUP_TIMEOUT, log.name))
+
+
+# keep the server's own view of the run (/metrics of all workers) next to its log
+def save_metrics(base_url, log_dir):
+    try:
+        with urllib.request.urlopen(base_url + '/metrics', timeout=REQUEST_TIMEOUT) as response:
+            text = response.read().decode('utf-8')
+    except (OSError, urllib.error.URLError):
+        return
+    with open(os.path.join(log_dir, 'metrics.txt'), 'w') as f:
+        f.write(text)
+
+
+# parse route=weight pairs
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in MIX:
+            raise argparse.ArgumentTypeError('unknown route %s (choose from %s)' % (route, ', '.join(MIX)))
+        mix[route] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a population, serve the app with gunicorn on localhost and '
+                                                 'drive logged in sessions at it, printing per route results as JSON.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--draws', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=32, help='concurrent sessions')
+    parser.add_argument('--session-length', type=int, default=20, help='requests per login')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+                        help='route weights, e.g. create_draw=60,check_draws=30,view_draws=10')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--preload', action='store_true', help='build the app in the gunicorn master')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    users = seed.seed(args.users, args.draws, args.seed)
+    # settle a round first, so check_draws has results to show
+    scenarios.run_lottery()
+
+    log_dir = tempfile.mkdtemp()
+    port = free_port()
+    server = start_gunicorn(port, args.workers, args.threads, log_dir, args.preload)
+
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=run_sessions,
+                                args=(i, args.sessions, users, 'http://127.0.0.1:%s' % port, args.mix,
+                                      args.session_length, stats, stop))
+               for i in range(args.sessions)]
+
+    try:
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        save_metrics('http://127.0.0.1:%s' % port, log_dir)
+    finally:
+        server.terminate()
+        server.wait()
+
+    routes = stats.report(duration)
+    total = sum(route['requests'] for route in routes.values())
+    errors = sum(route['errors'] for route in routes.values())
+
+    report = {
+        'commit': scenarios.git_commit(),
+        'users': args.users,
+        'draws': args.draws,
+        'sessions': args.sessions,
+        'session_length': args.session_length,
+        'mix': args.mix,
+        'workers': args.workers,
+        'threads': args.threads,
+        'preload': args.preload,
+        'duration': round(duration, 1),
+        'requests': total,
+        'requests_per_sec': round(total / duration, 1),
+        'error_rate': round(errors / total, 4) if total else 0,
+        'routes': routes,
+        'server_log': os.path.join(log_dir, 'gunicorn.log'),
+        'server_metrics': os.path.join(log_dir, 'metrics.txt'),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# IMPORTS
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# seeds (and selects) the benchmark database, so it is imported before the app
+from benchmarks import seed
+
+import pyotp
+
+from admin import jobs
+from models import User, RoundJob
+
+# CONFIG
+# directory holding app.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the app the population was seeded through
+app = seed.app
+# scenarios in the order they run (check_draws needs a settled round)
+SCENARIOS = ('login', 'create_draw', 'view_draws', 'run_lottery', 'check_draws')
+# hidden CSRF field rendered by flask_wtf forms
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+# CSRF token in a rendered page (None if it has no form)
+def csrf_token_of(text):
+    match = CSRF_TOKEN.search(text)
+    return match.group(1) if match else None
+
+
+# CSRF token of the form rendered by a request
+def csrf_token(response):
+    return csrf_token_of(response.get_data(as_text=True))
+
+
+# test client logged in as a user, with a CSRF token for its session
+def client_for(user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    # an empty draw form fails validation and is rendered again with the session's token
+    client.token = csrf_token(client.post('/create_draw'))
+    return client
+
+
+# peak resident set size of this process so far
+def peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# time count calls of operation(i), which returns whether the call succeeded
+def timed(operation, count):
+    latencies = []
+    errors = 0
+
+    start = time.perf_counter()
+    for i in range(count):
+        call_start = time.perf_counter()
+        if not operation(i):
+            errors += 1
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 \
+        else [latencies[0]] * 99
+    return {
+        'ops': count,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'ops_per_sec': round(count / elapsed, 1),
+        'p50_ms': round(percentiles[49] * 1000, 2),
+        'p99_ms': round(percentiles[98] * 1000, 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# log in through the login form (CSRF token, password and TOTP pin) with a new session each time
+def login(users, requests):
+    def operation(i):
+        user = users[i % len(users)]
+        client = app.test_client()
+        token = csrf_token(client.get('/login'))
+        response = client.post('/login', data={'email': seed.user_email(i % len(users)),
+                                               'password': seed.PASSWORD,
+                                               'pin': pyotp.TOTP(user.pin_key).now(),
+                                               'csrf_token': token})
+        # a successful login redirects to the lottery page
+        return response.status_code == 302
+
+    return timed(operation, requests)
+
+
+# submit one draw through the draw form
+def create_draw(clients, requests, rng):
+    def operation(i):
+        client = clients[i % len(clients)]
+        ticket = seed.random_ticket(rng)
+        data = {'number%s' % (n + 1): number for n, number in enumerate(ticket)}
+        data['csrf_token'] = client.token
+        return client.post('/create_draw', data=data).status_code == 302
+
+    return timed(operation, requests)
+
+
+# view the open tickets
+def view_draws(clients, requests):
+    return timed(lambda i: clients[i % len(clients)].post('/view_draws').status_code == 200, requests)
+
+
+# generate a winning draw and settle the round through the admin pages, counting settled tickets as ops
+def run_lottery():
+    with app.app_context():
+        admin_id = User.query.filter_by(role='admin').first().id
+    admin = client_for(admin_id)
+    admin.get('/generate_winning_draw')
+
+    settled = []
+
+    def operation(i):
+        admin.get('/run_lottery')
+        # wait for the background settlement job
+        for future in list(jobs.running.values()):
+            future.result()
+
+        with app.app_context():
+            job = RoundJob.query.order_by(RoundJob.id.desc()).first()
+            settled.append(job.processed)
+            return job.status == 'finished'
+
+    result = timed(operation, 1)
+    result['ops'] = settled[0]
+    result['ops_per_sec'] = round(settled[0] / result['seconds'], 1)
+    return result
+
+
+# view the results of the settled round
+def check_draws(clients, requests):
+    return timed(lambda i: clients[i % len(clients)].get('/check_draws').status_code == 200, requests)
+
+
+# commit being measured (None outside a git checkout)
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=ROOT).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a population and time the main pages through the test client, '
+                                                 'printing the results as JSON.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--draws', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    # the reCAPTCHA field of the login form passes in testing mode
+    app.config['TESTING'] = True
+
+    start = time.perf_counter()
+    users = seed.seed(args.users, args.draws, args.seed)
+    seed_seconds = time.perf_counter() - start
+
+    clients = [client_for(user.id) for user in users]
+    rng = random.Random(args.seed)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if scenario not in args.scenarios:
+            continue
+        if scenario == 'login':
+            results[scenario] = login(users, args.requests)
+        elif scenario == 'create_draw':
+            results[scenario] = create_draw(clients, args.requests, rng)
+        elif scenario == 'view_draws':
+            results[scenario] = view_draws(clients, args.requests)
+        elif scenario == 'run_lottery':
+            results[scenario] = run_lottery()
+        elif scenario == 'check_draws':
+            results[scenario] = check_draws(clients, args.requests)
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'users': args.users,
+        'draws': args.draws,
+        'requests': args.requests,
+        'seed': args.seed,
+        'seed_seconds': round(seed_seconds, 1),
+        'scenarios': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# IMPORTS
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+# run against BENCHMARK_DATABASE_URI, or a throwaway database (set before the app is imported)
+os.environ['SQLALCHEMY_DATABASE_URI'] = os.getenv('BENCHMARK_DATABASE_URI') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+# benchmark tickets are throwaway, so their match tokens use a fixed key unless one is set
+os.environ.setdefault('MATCH_TOKEN_KEY', 'benchmark-match-token-key')
+
+import bcrypt
+import pyotp
+from cryptography.fernet import Fernet
+from sqlalchemy import insert
+
+from app import create_app, db
+import models
+import shards
+from lottery import bulk
+from models import User, Draw
+
+# CONFIG
+# the app seeded (and measured by the other benchmarks)
+app = create_app()
+# password of every seeded user, and the bcrypt cost it is hashed at (far below the production cost)
+PASSWORD = 'Benchmark1!'
+BCRYPT_ROUNDS = 4
+# rows inserted per statement and transaction
+BATCH_SIZE = 10000
+
+
+# email of the nth seeded user
+def user_email(n):
+    return 'benchmark%s@email.com' % n
+
+
+# a random ticket from a seeded generator
+def random_ticket(rng):
+    return tuple(sorted(rng.sample(range(bulk.LOWEST_NUMBER, bulk.HIGHEST_NUMBER + 1), bulk.NUMBERS_PER_DRAW)))
+
+
+# create the admin and a number of users (all with PASSWORD), returning their ids, pin keys and Fernet keys
+def seed_users(users):
+    app.config['BCRYPT_ROUNDS'] = BCRYPT_ROUNDS
+    models.init_db(app)
+
+    # one hash for every user: bcrypt salts make them all valid, and hashing each would dominate seeding
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+    registered_on = datetime.now()
+
+    rows = [{
+        'email': user_email(n),
+        'password': password,
+        'pin_key': pyotp.random_base32(),
+        'firstname': 'Bench',
+        'lastname': 'Mark',
+        'phone': '0191-123-4567',
+        'role': 'user',
+        'registered_on': registered_on,
+        'key': Fernet.generate_key(),
+        'cleared_round': 0,
+    } for n in range(users)]
+
+    with app.app_context():
+        for start in range(0, len(rows), BATCH_SIZE):
+            db.session.execute(insert(User), rows[start:start + BATCH_SIZE])
+            db.session.commit()
+
+        return db.session.execute(db.select(User.id, User.pin_key, User.key).where(User.role == 'user')
+                                  .order_by(User.id)).all()
+
+
+# enter a number of open tickets spread evenly over the users, encrypted with their owners' keys
+def seed_draws(users, draws, seed_value=0):
+    rng = random.Random(seed_value)
+    ciphers = [(user.id, Fernet(user.key)) for user in users]
+
+    with app.app_context():
+        # a batch of rows for each shard
+        rows = [[] for _ in range(shards.count())]
+        for n in range(draws):
+            user_id, cipher = ciphers[n % len(ciphers)]
+            ticket = random_ticket(rng)
+            shard = shards.shard_of(user_id)
+            rows[shard].append({
+                'user_id': user_id,
+                'numbers': cipher.encrypt(bytes(models.format_numbers(ticket), 'utf-8')),
+                'been_played': False,
+                'matches_master': False,
+                'master_draw': False,
+                'lottery_round': 0,
+                'matched_count': 0,
+                'match_token': models.match_token(ticket),
+            })
+
+            if len(rows[shard]) == BATCH_SIZE:
+                shards.execute(shard, insert(Draw), rows[shard])
+                db.session.commit()
+                rows[shard] = []
+
+        for shard, batch in enumerate(rows):
+            if batch:
+                shards.execute(shard, insert(Draw), batch)
+        db.session.commit()
+
+
+# create a population of users with draws, returning the seeded users
+def seed(users, draws, seed_value=0):
+    seeded = seed_users(users)
+    seed_draws(seeded, draws, seed_value)
+    return seeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a benchmark database (BENCHMARK_DATABASE_URI, '
+                                                 'or a throwaway one) with users and open tickets.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--draws', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    seed(args.users, args.draws, args.seed)
+    print('Seeded %s users and %s draws into %s in %.1fs' % (args.users, args.draws,
+                                                             os.environ['SQLALCHEMY_DATABASE_URI'],
+                                                             time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# IMPORTS
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+# importing the benchmarks seeds a throwaway database and sets the match token key the servers inherit
+from benchmarks.load import free_port
+from benchmarks.scenarios import git_commit
+
+# CONFIG
+# directory holding app.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds allowed for gunicorn to start answering, and for a single request
+STARTUP_TIMEOUT = 30
+REQUEST_TIMEOUT = 30
+# gunicorn app of this tree (app:app for trees built at import time)
+TARGET = 'app:create_app()'
+# builds the app in a fresh interpreter, printing the seconds taken, the peak RSS and the heavy modules loaded
+COLD_START = '''
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+module, expression = sys.argv[1].split(':')
+namespace = vars(importlib.import_module(module))
+eval(expression, namespace)
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'heavy_modules': sorted(name for name in ('numpy', 'flask_qrcode', 'PIL') if name in sys.modules)}))
+'''
+
+
+# time building the app in new interpreters, as a gunicorn worker without --preload does
+def cold_start(target, runs, env, cwd):
+    results = [json.loads(subprocess.run([sys.executable, '-c', COLD_START, target], env=env, cwd=cwd, check=True,
+                                         capture_output=True, text=True).stdout)
+               for _ in range(runs)]
+
+    return {
+        'seconds_median': round(statistics.median(result['seconds'] for result in results), 3),
+        'seconds_min': round(min(result['seconds'] for result in results), 3),
+        'peak_rss_mb': round(statistics.median(result['rss_kb'] for result in results) / 1024, 1),
+        'heavy_modules': results[0]['heavy_modules'],
+    }
+
+
+# resident and proportional set size of a process in MiB (PSS splits pages shared with other processes)
+def memory_mb(pid):
+    sizes = {}
+    with open('/proc/%s/smaps_rollup' % pid) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                sizes[name.lower() + '_mb'] = round(int(value.split()[0]) / 1024, 1)
+    return sizes
+
+
+# pids of the workers of a gunicorn master
+def worker_pids(master_pid):
+    with open('/proc/%s/task/%s/children' % (master_pid, master_pid)) as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+# start gunicorn, time its first response, then warm every worker and measure their memory
+def serve(target, workers, preload, requests, env, log_dir):
+    port = free_port()
+    log = open(os.path.join(log_dir, 'gunicorn-%s.log' % ('preload' if preload else 'fork')), 'w')
+    command = [sys.executable, '-m', 'gunicorn',
+               '--pythonpath', ROOT,
+               '--workers', str(workers),
+               '--bind', '127.0.0.1:%s' % port]
+    # trees from before gunicorn.conf.py run without it
+    if os.path.exists(os.path.join(ROOT, 'gunicorn.conf.py')):
+        command += ['--config', os.path.join(ROOT, 'gunicorn.conf.py')]
+    if preload:
+        command.append('--preload')
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command + [target], cwd=log_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    try:
+        first_response = None
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while first_response is None and time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen('http://127.0.0.1:%s/login' % port, timeout=1).close()
+                first_response = time.perf_counter() - start
+            except (OSError, urllib.error.URLError):
+                time.sleep(0.05)
+        if first_response is None:
+            raise RuntimeError('gunicorn did not start, see %s' % log.name)
+
+        # requests spread over the workers, so each has rendered pages before it is measured
+        for _ in range(requests):
+            urllib.request.urlopen('http://127.0.0.1:%s/login' % port, timeout=REQUEST_TIMEOUT).close()
+
+        memory = [memory_mb(pid) for pid in worker_pids(process.pid)]
+        return {
+            'first_response_seconds': round(first_response, 3),
+            'master': memory_mb(process.pid),
+            'worker_rss_mb': round(statistics.mean(worker['rss_mb'] for worker in memory), 1),
+            'worker_pss_mb': round(statistics.mean(worker['pss_mb'] for worker in memory), 1),
+            'total_pss_mb': round(sum(worker['pss_mb'] for worker in memory) + memory_mb(process.pid)['pss_mb'], 1),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure worker cold start and memory of the app under gunicorn, '
+                                                 'with and without --preload, printing the results as JSON.')
+    parser.add_argument('--target', default=TARGET, help='gunicorn app, e.g. app:app for a tree without create_app')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts timed')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=40, help='warm-up requests before measuring memory')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(log_dir, 'startup.db'),
+    })
+
+    report = {
+        'commit': git_commit(),
+        'target': args.target,
+        'workers': args.workers,
+        'cold_start': cold_start(args.target, args.runs, env, log_dir),
+        'gunicorn': serve(args.target, args.workers, False, args.requests, env, log_dir),
+        'gunicorn_preload': serve(args.target, args.workers, True, args.requests, env, log_dir),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
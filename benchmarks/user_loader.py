@@ -0,0 +1,71 @@
+# IMPORTS
+# seeds (and selects) the benchmark database, so it is imported before the app
+from benchmarks import seed
+
+from sqlalchemy import event
+
+from app import db
+from lottery import bulk
+
+# CONFIG
+# the app measured
+app = seed.app
+# pages of a logged in user and the number of requests made to each
+PAGES = [('GET', '/lottery'), ('GET', '/account'), ('POST', '/view_draws'), ('POST', '/check_draws')]
+REQUESTS = 50
+
+
+# create a user with a few draws, returning its id
+def populate():
+    user = seed.seed_users(1)[0]
+
+    with app.app_context():
+        # draws go to the user's shard
+        bulk.insert_tickets(user, [(1, 2, 3, 4, 5, 6), (7, 8, 9, 10, 11, 12)])
+
+    return user.id
+
+
+# average number of SQL statements per request to a page
+def queries_per_request(user_id, method, path):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    count = [0]
+
+    def count_query(*args):
+        count[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    try:
+        for _ in range(REQUESTS):
+            client.open(path, method=method)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_query)
+
+    return count[0] / REQUESTS
+
+
+def main():
+    # statement logging would dominate the timings
+    with app.app_context():
+        db.engine.echo = False
+
+    user_id = populate()
+
+    print('%-14s %12s %12s' % ('page', 'cache off', 'cache on'))
+    for method, path in PAGES:
+        app.config['USER_CACHE'] = False
+        before = queries_per_request(user_id, method, path)
+        app.config['USER_CACHE'] = True
+        after = queries_per_request(user_id, method, path)
+        print('%-14s %12.2f %12.2f' % (path, before, after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# IMPORTS
+import hashlib
+
+from flask import make_response, request, session
+
+# CONFIG
+# pages of one user: the browser keeps them but checks the ETag before each reuse, shared caches never store them
+CACHE_CONTROL = 'private, no-cache'
+
+
+# ETag of a page built from the values it depends on
+def etag_for(parts):
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+# serve a GET conditionally: 304 when the browser's copy was built from the same parts, otherwise render it
+def conditional(parts, render):
+    # POSTs are not cached, and a 304 would lose flash messages waiting to be shown
+    if request.method != 'GET' or session.get('_flashes'):
+        return render()
+
+    tag = etag_for(parts)
+
+    if request.if_none_match.contains_weak(tag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+
+    # weak: the same parts give the same page, though not necessarily the same bytes
+    response.set_etag(tag, weak=True)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.vary.add('Cookie')
+
+    return response
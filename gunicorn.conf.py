@@ -0,0 +1,20 @@
+# IMPORTS
+import os
+import shutil
+import sys
+
+# the app's modules are importable however gunicorn is started (--config from another directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import metrics
+
+
+# start from empty metric files: those of an earlier server would be added to this one's
+def on_starting(server):
+    shutil.rmtree(metrics.METRICS_DIR, ignore_errors=True)
+    os.makedirs(metrics.METRICS_DIR, exist_ok=True)
+
+
+# drop the in-flight gauge of a worker that exited, so it no longer counts
+def child_exit(server, worker):
+    metrics.worker_exited(worker.pid)
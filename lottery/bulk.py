@@ -0,0 +1,122 @@
+# IMPORTS
+import secrets
+
+from sqlalchemy import insert
+
+import metrics
+import models
+import shards
+from app import db
+from lottery import cache
+from models import Draw
+
+# CONFIG
+# most draws accepted in one bulk submission
+MAX_TICKETS = 1000
+# numbers allowed in a draw (same range as DrawForm)
+LOWEST_NUMBER = 1
+HIGHEST_NUMBER = 60
+NUMBERS_PER_DRAW = 6
+# most lucky dip draws generated in one request
+MAX_QUICK_PICKS = 10000
+
+
+# check one submitted line, returning the canonical ticket and an error message (None when valid)
+def validate_ticket(line):
+    if not isinstance(line, list) or len(line) != NUMBERS_PER_DRAW:
+        return None, 'A draw must have %s numbers' % NUMBERS_PER_DRAW
+
+    # bool is an int subclass but not a number of a draw
+    if any(not isinstance(n, int) or isinstance(n, bool) for n in line):
+        return None, 'Numbers must be whole numbers'
+
+    if any(n < LOWEST_NUMBER or n > HIGHEST_NUMBER for n in line):
+        return None, 'Numbers must be between %s and %s' % (LOWEST_NUMBER, HIGHEST_NUMBER)
+
+    if len(set(line)) != len(line):
+        return None, 'Numbers cannot be same'
+
+    return tuple(sorted(line)), None
+
+
+# validate every line in one pass, returning the accepted tickets and the per-line results
+def validate_tickets(lines):
+    tickets = []
+    results = []
+
+    for i, line in enumerate(lines):
+        ticket, error = validate_ticket(line)
+
+        if error:
+            results.append({'line': i, 'accepted': False, 'error': error})
+        else:
+            tickets.append(ticket)
+            results.append({'line': i, 'accepted': True, 'numbers': models.format_numbers(ticket)})
+
+    return tickets, results
+
+
+# pick one random ticket as a bitmask (Floyd's sampling: exactly one random number per pick, no lists)
+def quick_pick_mask():
+    mask = 0
+    span = HIGHEST_NUMBER - LOWEST_NUMBER + 1
+
+    for j in range(span - NUMBERS_PER_DRAW, span):
+        t = secrets.randbelow(j + 1)
+        # if t was already picked, pick j (which cannot have been picked yet)
+        mask |= 1 << (j if mask >> t & 1 else t)
+
+    return mask
+
+
+# turn a quick pick bitmask into a sorted ticket
+def mask_ticket(mask):
+    ticket = []
+
+    # take the lowest set bit until none are left
+    while mask:
+        low = mask & -mask
+        ticket.append(low.bit_length() - 1 + LOWEST_NUMBER)
+        mask ^= low
+
+    return tuple(ticket)
+
+
+# generate count unique sorted tickets
+def quick_picks(count):
+    masks = set()
+
+    # duplicates within the batch are simply picked again
+    while len(masks) < count:
+        masks.add(quick_pick_mask())
+
+    return [mask_ticket(mask) for mask in masks]
+
+
+# encrypt tickets for a user and insert them with one bulk INSERT in one transaction
+def insert_tickets(user, tickets):
+    if not tickets:
+        return 0
+
+    # one cipher for the whole batch
+    cipher = models.get_cipher(user.key)
+
+    with metrics.timer('fernet'):
+        rows = [{
+            'user_id': user.id,
+            'numbers': cipher.encrypt(bytes(models.format_numbers(ticket), 'utf-8')),
+            'been_played': False,
+            'matches_master': False,
+            'master_draw': False,
+            'lottery_round': 0,
+            'matched_count': 0,
+            'match_token': models.match_token(ticket),
+        } for ticket in tickets]
+
+    # one cached INSERT executed for every row (a literal multi-row VALUES statement
+    # has to be compiled again for every batch size and is several times slower)
+    shards.execute_for(user.id, insert(Draw), rows)
+    db.session.commit()
+    cache.invalidate([user.id])
+
+    return len(rows)
@@ -0,0 +1,165 @@
+# IMPORTS
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import current_app
+
+# CONFIG
+# connection to the cache file of each thread (and process)
+local = threading.local()
+# share of the memory cap left in use after evicting
+EVICT_TO = 0.9
+# seconds a connection waits for another worker's write
+TIMEOUT = 5
+# seconds before a hit refreshes an entry's last use (a refresh takes the write lock, so most hits only read)
+REFRESH_AFTER = 60
+
+
+# the cache file: DRAW_CACHE_PATH, or a file in shared memory named after the database
+def cache_path():
+    if current_app.config['DRAW_CACHE_PATH']:
+        return current_app.config['DRAW_CACHE_PATH']
+
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    database = hashlib.sha1(str(current_app.config['SQLALCHEMY_DATABASE_URI']).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(directory, 'lottery-draw-cache-%s.db' % database)
+
+
+# get this thread's connection to the cache file shared by every worker
+def connect():
+    connection = getattr(local, 'connection', None)
+
+    # a forked worker opens its own connection
+    if connection is None or local.pid != os.getpid():
+        path = cache_path()
+        # the file holds decrypted draws, so only the app's user may read it
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+
+        connection = sqlite3.connect(path, timeout=TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # the cache can be rebuilt from the database, so it is never synced
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE IF NOT EXISTS entries (user_id INTEGER NOT NULL, kind TEXT NOT NULL, '
+                           'value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL, '
+                           'PRIMARY KEY (user_id, kind))')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)')
+        # bumped on every change to a user's draws, so a value loaded before the change is not cached
+        connection.execute('CREATE TABLE IF NOT EXISTS versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)')
+
+        local.connection = connection
+        local.pid = os.getpid()
+
+    return connection
+
+
+# run statements in one write transaction
+def write(statements):
+    connection = connect()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        result = statements(connection)
+        connection.execute('COMMIT')
+        return result
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+# current version of a user's draws
+def version(user_id, connection=None):
+    row = (connection or connect()).execute('SELECT version FROM versions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# get a cached value, or None if missing
+def get(user_id, kind):
+    connection = connect()
+    row = connection.execute('SELECT value, used FROM entries WHERE user_id = ? AND kind = ?',
+                             (user_id, kind)).fetchone()
+
+    if row is None:
+        return None
+
+    # eviction only needs a rough order of last use
+    now = time.time()
+    if now - row[1] > REFRESH_AFTER:
+        connection.execute('UPDATE entries SET used = ? WHERE user_id = ? AND kind = ?', (now, user_id, kind))
+    return json.loads(row[0])
+
+
+# drop the least recently used entries once the cache is over DRAW_CACHE_MAX_BYTES
+def evict(connection):
+    limit = current_app.config['DRAW_CACHE_MAX_BYTES']
+    total = connection.execute('SELECT total(size) FROM entries').fetchone()[0]
+    if total <= limit:
+        return
+
+    excess = total - limit * EVICT_TO
+    dropped = []
+    for user_id, kind, size in connection.execute('SELECT user_id, kind, size FROM entries ORDER BY used'):
+        dropped.append((user_id, kind))
+        excess -= size
+        if excess <= 0:
+            break
+
+    connection.executemany('DELETE FROM entries WHERE user_id = ? AND kind = ?', dropped)
+
+
+# cache a value loaded at version seen (skipped if the user's draws changed since)
+def put(user_id, kind, value, seen):
+    data = json.dumps(value)
+    if len(data) > current_app.config['DRAW_CACHE_MAX_BYTES']:
+        return
+
+    def statements(connection):
+        if version(user_id, connection) != seen:
+            return
+        connection.execute('INSERT OR REPLACE INTO entries (user_id, kind, value, size, used) VALUES (?, ?, ?, ?, ?)',
+                           (user_id, kind, data, len(data), time.time()))
+        evict(connection)
+
+    write(statements)
+
+
+# drop every cached value of the users (new tickets, play again, settlement)
+def invalidate(user_ids):
+    if not current_app.config['DRAW_CACHE']:
+        return
+
+    user_ids = [(user_id,) for user_id in set(user_ids)]
+
+    def statements(connection):
+        connection.executemany('INSERT INTO versions (user_id, version) VALUES (?, 1) '
+                               'ON CONFLICT (user_id) DO UPDATE SET version = version + 1', user_ids)
+        connection.executemany('DELETE FROM entries WHERE user_id = ?', user_ids)
+
+    write(statements)
+
+
+# drop every cached value (the database was recreated)
+def clear():
+    if not current_app.config['DRAW_CACHE']:
+        return
+
+    write(lambda connection: connection.execute('DELETE FROM entries'))
+
+
+# get a user's cached value, or load it and cache it
+def cached(user_id, kind, load):
+    if not current_app.config['DRAW_CACHE']:
+        return load()
+
+    value = get(user_id, kind)
+
+    if value is None:
+        # read the version before loading, so a change made while loading is noticed
+        seen = version(user_id)
+        value = load()
+        put(user_id, kind, value, seen)
+
+    return value
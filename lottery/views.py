@@ -1,11 +1,17 @@
 # IMPORTS
-from flask import Blueprint, render_template, flash, redirect, url_for
+import time
+
+from flask import Blueprint, render_template, flash, redirect, url_for, request, jsonify, abort
 from flask_login import login_required, current_user
+from sqlalchemy import select, func
 
+import etags
 import models
+import shards
 from app import db
+from lottery import bulk, cache
 from lottery.forms import DrawForm
-from models import Draw
+from models import Draw, ArchivedDraw
 
 # CONFIG
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
@@ -25,12 +31,8 @@ def create_draw():
     form = DrawForm()
 
     if form.validate_on_submit():
-        # finished string of numbers
-        submitted_numbers = ''
         # list to get numbers from form
         prepared_numbers = []
-        # previous number to compare
-        previous_num = 0
 
         # add submitted numbers to the list
         prepared_numbers.append(int(form.number1.data))
@@ -41,22 +43,16 @@ def create_draw():
         prepared_numbers.append(int(form.number6.data))
 
         # check for repeated numbers in a form
-        for i in prepared_numbers:
-            if i == previous_num:
-                flash('Error! Numbers cannot be same' % prepared_numbers)
-                return redirect(url_for('lottery.lottery'))
-
-            submitted_numbers += (' ' + str(i))
+        if len(set(prepared_numbers)) != len(prepared_numbers):
+            flash('Error! Numbers cannot be same')
+            return redirect(url_for('lottery.lottery'))
 
-            previous_num = i
-        # encrypt the numbers
-        encrypted_numbers = models.encrypt(submitted_numbers, current_user.key)
+        # canonical (sorted) ticket and its string of numbers
+        ticket = tuple(sorted(prepared_numbers))
+        submitted_numbers = models.format_numbers(ticket)
 
-        # create a new draw with the form data.
-        new_draw = Draw(user_id=current_user.id, numbers=encrypted_numbers, master_draw=False, lottery_round=0)
-        # add the new draw to the database
-        db.session.add(new_draw)
-        db.session.commit()
+        # encrypt the numbers and add the new draw to the user's shard
+        bulk.insert_tickets(current_user, [ticket])
 
         # re-render lottery.page
         flash('Draw %s submitted.' % submitted_numbers)
@@ -65,19 +61,66 @@ def create_draw():
     return render_template('lottery/lottery.html', name=current_user.firstname, form=form)
 
 
+# submit many draws at once as JSON: {"draws": [[1, 2, 3, 4, 5, 6], ...]}
+@lottery_blueprint.route('/create_draws', methods=['POST'])
+@login_required
+def create_draws():
+    # only JSON bodies are accepted, which a cross-site form cannot send
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('draws'), list):
+        abort(400)
+
+    lines = data['draws']
+    if len(lines) > bulk.MAX_TICKETS:
+        return jsonify({'error': 'At most %s draws can be submitted at once.' % bulk.MAX_TICKETS}), 413
+
+    start = time.perf_counter()
+
+    # validate every line, then encrypt and insert the accepted ones in one transaction
+    tickets, results = bulk.validate_tickets(lines)
+    bulk.insert_tickets(current_user, tickets)
+
+    return jsonify({'accepted': len(tickets),
+                    'rejected': len(lines) - len(tickets),
+                    'results': results,
+                    'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)})
+
+
+# generate lucky dip draws on the server as JSON: {"count": 50}
+@lottery_blueprint.route('/lucky_dip', methods=['POST'])
+@login_required
+def lucky_dip():
+    # only JSON bodies are accepted, which a cross-site form cannot send
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    count = data.get('count', 1)
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= bulk.MAX_QUICK_PICKS:
+        return jsonify({'error': 'Count must be between 1 and %s.' % bulk.MAX_QUICK_PICKS}), 400
+
+    # generate unique tickets and insert them in one transaction
+    tickets = bulk.quick_picks(count)
+    bulk.insert_tickets(current_user, tickets)
+
+    return jsonify({'accepted': len(tickets), 'draws': [models.format_numbers(ticket) for ticket in tickets]})
+
+
 # view all draws that have not been played
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 def view_draws():
-    # get all draws that have not been played [played=0]
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()
+    # get all draws that have not been played [played=0], decrypted (cached until the user's draws change)
+    def load():
+        query = select(Draw.numbers) \
+            .where(Draw.been_played == False, Draw.user_id == current_user.id) \
+            .order_by(Draw.id)
+        return [models.decrypt(numbers, current_user.key)
+                for numbers in shards.execute_for(current_user.id, query).scalars()]
+
+    playable_draws = [{'numbers': numbers} for numbers in cache.cached(current_user.id, 'playable', load)]
 
     # if playable draws exist
     if len(playable_draws) != 0:
-        for i in playable_draws:
-            # decrypt the numbers
-            numbers = models.decrypt(i.numbers, current_user.key)
-            i.numbers = numbers
-
         # re-render lottery page with playable draws
         return render_template('lottery/lottery.html', playable_draws=playable_draws)
     else:
@@ -85,29 +128,64 @@ def view_draws():
         return lottery()
 
 
-# view lottery results
-@lottery_blueprint.route('/check_draws', methods=['POST'])
+# view lottery results (a conditional GET: 304 until the user's results change)
+@lottery_blueprint.route('/check_draws', methods=['GET', 'POST'])
 def check_draws():
-    # get played draws
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()
-
-    # if played draws exist
-    if len(played_draws) != 0:
-        return render_template('lottery/lottery.html', results=played_draws, played=True)
-
-    # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
-    else:
-        flash("Next round of lottery yet to play. Check you have playable draws.")
-        return lottery()
-
-
-# delete all played draws
+    # get played draws of the rounds since the user last cleared them from the archive, decrypted
+    # (cached until the user's draws change)
+    cleared_round = current_user.cleared_round
+
+    def load():
+        query = select(ArchivedDraw.lottery_round, ArchivedDraw.numbers, ArchivedDraw.matches_master) \
+            .where(ArchivedDraw.user_id == current_user.id, ArchivedDraw.lottery_round > cleared_round,
+                   ArchivedDraw.master_draw == False) \
+            .order_by(ArchivedDraw.lottery_round, ArchivedDraw.draw_id)
+        return [{'lottery_round': draw.lottery_round,
+                 'numbers': models.decrypt(draw.numbers, current_user.key),
+                 'been_played': True,
+                 'matches_master': draw.matches_master}
+                for draw in shards.execute_for(current_user.id, query)]
+
+    def render():
+        # keyed by the cleared round too: another worker's cached user may still have the one before play again,
+        # and must not cache its uncleared results for everyone
+        results = cache.cached(current_user.id, 'results:%s' % cleared_round, load)
+
+        # if played draws exist
+        if len(results) != 0:
+            return render_template('lottery/lottery.html', results=results, played=True)
+
+        # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
+        else:
+            flash("Next round of lottery yet to play. Check you have playable draws.")
+            return lottery()
+
+    # the archive is append-only, so the results only change with a new archived draw (a settled round)
+    # or play again
+    # (archive ids are per shard, but a user's draws are all on one)
+    latest_round, latest_id = shards.execute_for(
+        current_user.id,
+        select(func.max(ArchivedDraw.lottery_round), func.max(ArchivedDraw.id))
+        .where(ArchivedDraw.user_id == current_user.id)
+    ).one()
+
+    return etags.conditional(('check_draws', current_user.id, latest_round, latest_id, current_user.cleared_round),
+                             render)
+
+
+# clear all played draws (they stay in the archive)
 @lottery_blueprint.route('/play_again', methods=['POST'])
 def play_again():
-    Draw.query.filter_by(been_played=True, master_draw=False, user_id=current_user.id).delete(synchronize_session=False)
-    db.session.commit()
+    latest = shards.execute_for(
+        current_user.id, select(func.max(ArchivedDraw.lottery_round)).where(ArchivedDraw.user_id == current_user.id)
+    ).scalar()
+
+    if latest and latest > current_user.cleared_round:
+        current_user.cleared_round = latest
+        db.session.commit()
+        cache.invalidate([current_user.id])
 
-    flash("All played draws deleted.")
+    flash("All played draws cleared.")
     return lottery()
 
 
@@ -0,0 +1,149 @@
+# IMPORTS
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+# CONFIG
+# directory of the metric files every worker writes to: METRICS_DIR (cleared by gunicorn.conf.py when the server
+# starts), or one of this process's own, which its workers and settlement processes inherit through the environment
+METRICS_DIR = os.getenv('METRICS_DIR')
+# process that created METRICS_DIR, and removes it when it exits
+METRICS_DIR_OWNER = None
+if not METRICS_DIR:
+    METRICS_DIR = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                               'lottery-metrics-%s' % os.getpid())
+    METRICS_DIR_OWNER = os.getpid()
+    # a directory left by an earlier process with the same pid
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.environ['METRICS_DIR'] = METRICS_DIR
+os.makedirs(METRICS_DIR, exist_ok=True)
+# prometheus_client picks its multiprocess (file backed) store when this is set before it is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS_DIR)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, \
+    multiprocess
+
+# metrics labelled by blueprint endpoint ('lottery.create_draw', 'admin.run_lottery', ...)
+REQUESTS = Counter('lottery_requests_total', 'Requests handled', ['endpoint', 'method', 'status'])
+LATENCY = Histogram('lottery_request_duration_seconds', 'Request latency', ['endpoint'])
+IN_FLIGHT = Gauge('lottery_requests_in_flight', 'Requests being handled', ['endpoint'], multiprocess_mode='livesum')
+QUERIES = Histogram('lottery_request_db_queries', 'SQL statements per request', ['endpoint'],
+                    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500, float('inf')))
+CRYPTO_SECONDS = Counter('lottery_crypto_seconds_total', 'Time spent in Fernet and bcrypt', ['endpoint', 'kind'])
+CIPHER_CACHE = Counter('lottery_cipher_cache_total', 'Per-user Fernet cipher cache lookups', ['result'])
+CIPHER_CACHE_SIZE = Gauge('lottery_cipher_cache_size', 'Fernet ciphers cached', multiprocess_mode='livesum')
+LOG_DROPPED = Counter('lottery_log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+
+# time a block of Fernet or bcrypt work, adding it to the current request's metrics
+@contextmanager
+def timer(kind):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            spent = g.get('metrics_crypto')
+            if spent is not None:
+                spent[kind] = spent.get(kind, 0.0) + time.perf_counter() - start
+
+
+# count the SQL statements of the current request
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('metrics_queries') is not None:
+        g.metrics_queries += 1
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_crypto = {}
+    IN_FLIGHT.labels(request.endpoint or 'none').inc()
+
+
+def after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+# record a finished request (also after an unhandled exception)
+def teardown_request(error):
+    start = g.get('metrics_start')
+    if start is None:
+        return
+
+    endpoint = request.endpoint or 'none'
+    IN_FLIGHT.labels(endpoint).dec()
+    REQUESTS.labels(endpoint, request.method, str(g.get('metrics_status', 500))).inc()
+    LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+    QUERIES.labels(endpoint).observe(g.metrics_queries)
+    for kind, spent in g.metrics_crypto.items():
+        CRYPTO_SECONDS.labels(endpoint, kind).inc(spent)
+    record_cipher_cache()
+
+
+# cipher cache counters of this process already added to the metrics
+cipher_cache_recorded = {'hits': 0, 'misses': 0}
+cipher_cache_lock = threading.Lock()
+
+
+# add the cipher cache hits and misses since the last call to the metrics (the cache keeps plain counters,
+# as it is consulted for every Fernet operation)
+def record_cipher_cache():
+    from models import cipher_cache_info
+
+    info = cipher_cache_info()
+    with cipher_cache_lock:
+        for result, name in (('hit', 'hits'), ('miss', 'misses')):
+            if info[name] > cipher_cache_recorded[name]:
+                CIPHER_CACHE.labels(result).inc(info[name] - cipher_cache_recorded[name])
+                cipher_cache_recorded[name] = info[name]
+        CIPHER_CACHE_SIZE.set(info['size'])
+
+
+# count log records dropped by the audit log queue (called by its writer thread)
+def log_records_dropped(count):
+    LOG_DROPPED.inc(count)
+
+
+# metrics of every worker in the Prometheus text format
+def metrics_view():
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+# instrument the app's requests and engine and serve /metrics (when METRICS is set)
+def init_app(app, db):
+    if not app.config['METRICS']:
+        return
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', count_query)
+
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+# remove this process's metrics directory when it exits (not when a forked worker does)
+def remove_metrics_dir():
+    if METRICS_DIR_OWNER == os.getpid():
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+
+atexit.register(remove_metrics_dir)
+
+
+# forget the live gauges of a worker that exited (called by gunicorn.conf.py)
+def worker_exited(pid):
+    multiprocess.mark_process_dead(pid, METRICS_DIR)
@@ -1,13 +1,22 @@
+import hashlib
+import hmac
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
-import bcrypt
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
+from flask import current_app
+from sqlalchemy import delete, insert, literal, select
 
-from app import db, app
+from app import db
+import metrics
+import shards
 from flask_login import UserMixin
 import pyotp
+from users import passwords
+from lottery import cache
 
 
 class User(db.Model, UserMixin):
@@ -30,9 +39,8 @@ class User(db.Model, UserMixin):
     last_login = db.Column(db.DateTime, nullable=True)
     # key information
     key = db.Column(db.BLOB, nullable=False)
-
-    # Define the relationship to Draw
-    draws = db.relationship('Draw')
+    # results of the rounds up to this one were cleared with play again
+    cleared_round = db.Column(db.Integer, nullable=False, default=0)
 
     def __init__(self, email, firstname, lastname, phone, password, role, registered_on):
         self.email = email
@@ -40,12 +48,13 @@ class User(db.Model, UserMixin):
         self.lastname = lastname
         self.phone = phone
         # hash the password before storing
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = passwords.hash_password(password)
         self.role = role
         self.registered_on = registered_on
         self.current_login = None
         self.last_login = None
         self.key = Fernet.generate_key()
+        self.cleared_round = 0
 
     # get the uri from email and pin key
     def get_2fa_uri(self):
@@ -56,7 +65,12 @@ class User(db.Model, UserMixin):
 
     # verify the hashed passwords
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'), self.password)
+        return passwords.check_password(password, self.password)
+
+    # rehash a verified password if the configured cost has changed (the caller commits)
+    def upgrade_password(self, password):
+        if passwords.needs_rehash(self.password):
+            self.password = passwords.hash_password(password)
 
     # verify the time-based pin keys
     def verify_pin(self, pin):
@@ -67,6 +81,16 @@ class User(db.Model, UserMixin):
 
 class Draw(db.Model):
     __tablename__ = 'draws'
+    __table_args__ = (
+        # settlement and the winning draw (master_draw, been_played)
+        db.Index('ix_draws_master_draw_been_played', 'master_draw', 'been_played'),
+        # a user's playable and played draws (user_id, been_played)
+        db.Index('ix_draws_user_id_been_played', 'user_id', 'been_played'),
+        # play again (been_played, master_draw, user_id)
+        db.Index('ix_draws_been_played_master_draw_user_id', 'been_played', 'master_draw', 'user_id'),
+        # winners and tier counts of a round
+        db.Index('ix_draws_lottery_round_tier', 'lottery_round', 'tier'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -88,20 +112,177 @@ class Draw(db.Model):
     # Lottery round that draw is used
     lottery_round = db.Column(db.Integer, nullable=False, default=0)
 
-    def __init__(self, user_id, numbers, master_draw, lottery_round):
+    # Number of winning numbers matched and prize tier won ('6', '5+bonus', '5', '4', '3' or NULL)
+    matched_count = db.Column(db.Integer, nullable=False, default=0)
+    tier = db.Column(db.String(10), nullable=True)
+
+    # Encrypted bonus number (master draws only)
+    bonus = db.Column(db.String(100), nullable=True)
+
+    # Keyed hash of the canonical ticket, equal for equal tickets (NULL for draws entered before tokens)
+    match_token = db.Column(db.String(64), nullable=True, index=True)
+
+    def __init__(self, user_id, numbers, master_draw, lottery_round, match_token=None, bonus=None):
         self.user_id = user_id
         self.numbers = numbers
+        self.match_token = match_token
+        self.bonus = bonus
         self.been_played = False
         self.matches_master = False
+        self.matched_count = 0
+        self.tier = None
         self.master_draw = master_draw
         self.lottery_round = lottery_round
 
 
-def init_db():
-    with app.app_context():
+class ArchivedDraw(db.Model):
+    __tablename__ = 'draw_archive'
+    __table_args__ = (
+        # a user's history (user_id, lottery_round)
+        db.Index('ix_draw_archive_user_id_lottery_round', 'user_id', 'lottery_round'),
+        # winners, tier counts and exports of a round
+        db.Index('ix_draw_archive_lottery_round_tier', 'lottery_round', 'tier'),
+    )
+
+    # Settled draws moved out of the live draws table (rows are appended, never deleted)
+    id = db.Column(db.Integer, primary_key=True)
+
+    # ID the draw had in the draws table
+    draw_id = db.Column(db.Integer, nullable=False)
+
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    lottery_round = db.Column(db.Integer, nullable=False)
+
+    # Encrypted numbers (and bonus number of master draws)
+    numbers = db.Column(db.String(100), nullable=False)
+    bonus = db.Column(db.String(100), nullable=True)
+
+    # Result of the draw in its round
+    master_draw = db.Column(db.BOOLEAN, nullable=False)
+    matches_master = db.Column(db.BOOLEAN, nullable=False)
+    matched_count = db.Column(db.Integer, nullable=False)
+    tier = db.Column(db.String(10), nullable=True)
+
+    archived_on = db.Column(db.DateTime, nullable=False)
+
+
+# tables of every shard (user draws are stored on their owner's shard, winning draws on the main database)
+SHARDED_TABLES = [Draw.__table__, ArchivedDraw.__table__]
+
+
+class Round(db.Model):
+    __tablename__ = 'rounds'
+
+    # Lottery round number
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # Winning draw of the round (NULL once it has been replaced)
+    master_draw_id = db.Column(db.Integer, db.ForeignKey(Draw.id), nullable=True)
+
+    created_on = db.Column(db.DateTime, nullable=False)
+
+    # Define the relationship to the winning Draw
+    master_draw = db.relationship('Draw')
+
+    def __init__(self, id, master_draw_id):
+        self.id = id
+        self.master_draw_id = master_draw_id
+        self.created_on = datetime.now()
+
+
+class RoundJob(db.Model):
+    __tablename__ = 'round_jobs'
+    __table_args__ = (
+        # one unfinished job per winning draw, so workers starting a round at once cannot both settle it
+        db.Index('ix_round_jobs_unfinished_master_draw_id', 'master_draw_id', unique=True,
+                 sqlite_where=db.text("status != 'finished'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Winning draw and lottery round being settled
+    master_draw_id = db.Column(db.Integer, db.ForeignKey(Draw.id), nullable=False)
+    lottery_round = db.Column(db.Integer, nullable=False)
+
+    # queued, running, finished or failed
+    status = db.Column(db.String(20), nullable=False, default='queued')
+
+    # Highest user draw id entered in the round on any shard (each shard's own is in its RoundJobShard)
+    max_draw_id = db.Column(db.Integer, nullable=False)
+    # Last user draw id of the last committed chunk, for jobs started before shards
+    last_draw_id = db.Column(db.Integer, nullable=False, default=0)
+
+    # Progress counters
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+
+    created_on = db.Column(db.DateTime, nullable=False)
+    updated_on = db.Column(db.DateTime, nullable=False)
+    finished_on = db.Column(db.DateTime, nullable=True)
+
+    # Define the relationship to the progress on each shard
+    shard_progress = db.relationship('RoundJobShard', order_by='RoundJobShard.shard')
+
+    def __init__(self, master_draw_id, lottery_round, max_draw_id, total):
+        self.master_draw_id = master_draw_id
+        self.lottery_round = lottery_round
+        self.status = 'queued'
+        self.max_draw_id = max_draw_id
+        self.last_draw_id = 0
+        self.total = total
+        self.processed = 0
+        self.winners = 0
+        self.created_on = datetime.now()
+        self.updated_on = self.created_on
+        self.finished_on = None
+
+
+class RoundJobShard(db.Model):
+    __tablename__ = 'round_job_shards'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Job and the shard whose draws are settled
+    job_id = db.Column(db.Integer, db.ForeignKey(RoundJob.id), nullable=False, index=True)
+    shard = db.Column(db.Integer, nullable=False)
+
+    # Highest user draw id of the shard entered in the round, and the last one of its last committed chunk
+    # (draw ids are numbered per shard)
+    max_draw_id = db.Column(db.Integer, nullable=False)
+    last_draw_id = db.Column(db.Integer, nullable=False, default=0)
+
+    # Progress counters of the shard
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, job_id, shard, max_draw_id, last_draw_id=0):
+        self.job_id = job_id
+        self.shard = shard
+        self.max_draw_id = max_draw_id
+        self.last_draw_id = last_draw_id
+        self.processed = 0
+        self.winners = 0
+
+
+# build an app for the database helpers when called from a shell
+def app_for(app):
+    if app is None:
+        from app import create_app
+        app = create_app()
+    return app
+
+
+def init_db(app=None):
+    with app_for(app).app_context():
         db.drop_all()
         db.create_all()
 
+        # the draw tables of the other shards
+        for n in range(1, shards.count()):
+            db.metadata.drop_all(shards.engine(n), tables=SHARDED_TABLES)
+            db.metadata.create_all(shards.engine(n), tables=SHARDED_TABLES)
+
         registered_on = datetime.now()
         email = 'admin@email.com'
 
@@ -116,21 +297,226 @@ def init_db():
         logging.warning('User [%s, %s] registered on %s',
                         email,
                         'localhost',
-                        registered_on)
+                        registered_on,
+                        extra={'event': 'register', 'user': email, 'ip': 'localhost'})
 
         db.session.add(admin)
         db.session.commit()
 
+        # the cached draws belonged to the dropped tables
+        cache.clear()
+
+
+# add the missing columns and indexes of tables in a database
+def migrate_tables(engine, tables):
+    inspector = db.inspect(engine)
+
+    for table in tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+        # add missing columns (SQLite can only add NOT NULL columns with a constant default)
+        with engine.begin() as connection:
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name,
+                                                          column.type.compile(dialect=engine.dialect))
+                if column.default is not None and column.default.is_scalar:
+                    ddl += ' NOT NULL DEFAULT %s' % int(column.default.arg)
+
+                connection.execute(db.text(ddl))
+                logging.warning('Added column %s.%s', table.name, column.name)
+
+        # build missing indexes
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+# move the user draws (open and archived) kept on another shard than their owner's, after DRAW_SHARDS was raised
+# (a moved draw gets a new id on its new shard; shards beyond DRAW_SHARDS are not read, so it is never lowered)
+def rebalance_shards():
+    moved = 0
+
+    for n in range(shards.count()):
+        for model in (Draw, ArchivedDraw):
+            owners = shards.execute(n, select(model.user_id).where(model.master_draw == False).distinct()).scalars()
+
+            for user_id in owners.all():
+                target = shards.shard_of(user_id)
+                if target == n:
+                    continue
+
+                owned = (model.user_id == user_id, model.master_draw == False)
+                columns = [column for column in model.__table__.columns if column.name != 'id']
+                rows = [dict(row._mapping) for row in shards.execute(n, select(*columns).where(*owned))]
+
+                shards.execute(target, insert(model), rows)
+                shards.execute(n, delete(model).where(*owned).execution_options(synchronize_session=False))
+                db.session.commit()
+                moved += len(rows)
+
+    if moved:
+        logging.warning('Moved %s draws to the shards of their owners', moved)
+        # the cached draws have new ids
+        cache.clear()
+
+
+# bring an existing database up to date with the models (new tables, columns and indexes)
+def migrate_db(app=None):
+    with app_for(app).app_context():
+        db.create_all()
+        migrate_tables(db.engine, db.metadata.sorted_tables)
+
+        # the draw tables of the other shards
+        for n in range(1, shards.count()):
+            db.metadata.create_all(shards.engine(n), tables=SHARDED_TABLES)
+            migrate_tables(shards.engine(n), SHARDED_TABLES)
+
+        # record the rounds of existing winning draws
+        if not Round.query.first():
+            for draw in Draw.query.filter_by(master_draw=True).order_by(Draw.lottery_round):
+                db.session.merge(Round(id=draw.lottery_round, master_draw_id=draw.id))
+            db.session.commit()
+
+        # move user draws played before the archive existed (encrypted again first, so they can be shown)
+        for n in range(shards.count()):
+            encrypt_plaintext_draws(n)
+            archive_draws(Draw.master_draw == False, Draw.been_played == True, shard=n)
+        db.session.commit()
+
+        # spread the user draws over the shards
+        rebalance_shards()
+
+
+# encrypt the user draws of a shard stored with plain numbers (rounds played before settlement kept them
+# encrypted wrote the decrypted numbers back) with their owner's key
+def encrypt_plaintext_draws(shard=0):
+    for model in (Draw, ArchivedDraw):
+        # Fernet tokens are base64, so only plain numbers contain a space
+        draws = shards.execute(shard, select(model.id, model.user_id, model.numbers)
+                               .where(model.master_draw == False, model.numbers.like('% %'))).all()
+        if not draws:
+            continue
+
+        owners = {draw.user_id for draw in draws}
+        keys = dict(db.session.execute(select(User.id, User.key).where(User.id.in_(owners))).all())
+        shards.update_by_id(shard, model, [{'id': draw.id, 'numbers': encrypt(draw.numbers, keys[draw.user_id])}
+                                           for draw in draws])
+        logging.warning('Encrypted %s played draws stored with plain numbers', len(draws))
+
+
+# move the draws of a shard matching the conditions to its archive with one INSERT ... SELECT and one DELETE
+# (committed by the caller, so a draw is never in both tables or in neither)
+def archive_draws(*conditions, shard=0):
+    source = select(Draw.id, Draw.user_id, Draw.lottery_round, Draw.numbers, Draw.bonus, Draw.master_draw,
+                    Draw.matches_master, Draw.matched_count, Draw.tier, literal(datetime.now(), db.DateTime)) \
+        .where(*conditions)
+
+    shards.execute(shard, insert(ArchivedDraw).from_select(['draw_id', 'user_id', 'lottery_round', 'numbers', 'bonus',
+                                                            'master_draw', 'matches_master', 'matched_count', 'tier',
+                                                            'archived_on'], source))
+    shards.execute(shard, delete(Draw).where(*conditions).execution_options(synchronize_session=False))
+
+
+# get the current (latest) lottery round
+def current_round():
+    return Round.query.order_by(Round.id.desc()).first()
+
+
+# get the winning draw of the current round by key
+def current_master_draw():
+    latest = current_round()
+
+    if latest and latest.master_draw_id:
+        return db.session.get(Draw, latest.master_draw_id)
+
+    return None
+
 
 # load the dotenv reader
 load_dotenv()
 
 
+# Fernet objects by key fingerprint, least recently used first (a user's key never changes; a new key would
+# simply get an entry of its own)
+cipher_cache = OrderedDict()
+cipher_cache_lock = threading.Lock()
+cipher_cache_stats = {'hits': 0, 'misses': 0}
+
+
+# fingerprint of a key, so the cache is not indexed by raw keys
+def key_fingerprint(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).digest()
+
+
+# get the (cached) Fernet object of a key
+def get_cipher(key):
+    fingerprint = key_fingerprint(key)
+
+    with cipher_cache_lock:
+        cipher = cipher_cache.get(fingerprint)
+        if cipher is not None:
+            cipher_cache.move_to_end(fingerprint)
+            cipher_cache_stats['hits'] += 1
+            return cipher
+        cipher_cache_stats['misses'] += 1
+
+    cipher = Fernet(key)
+
+    with cipher_cache_lock:
+        cipher_cache[fingerprint] = cipher
+        # evict the least recently used ciphers
+        while len(cipher_cache) > current_app.config['CIPHER_CACHE_SIZE']:
+            cipher_cache.popitem(last=False)
+
+    return cipher
+
+
+# cipher cache counters for metrics
+def cipher_cache_info():
+    with cipher_cache_lock:
+        return {
+            'hits': cipher_cache_stats['hits'],
+            'misses': cipher_cache_stats['misses'],
+            'size': len(cipher_cache),
+            'max_size': current_app.config['CIPHER_CACHE_SIZE'],
+        }
+
+
 # encrypt the numbers
 def encrypt(data, key):
-    return Fernet(key).encrypt(bytes(data, 'utf-8'))
+    with metrics.timer('fernet'):
+        return get_cipher(key).encrypt(bytes(data, 'utf-8'))
 
 
 # decrypt the numbers
 def decrypt(data, key):
-    return Fernet(key).decrypt(data).decode('utf-8')
\ No newline at end of file
+    with metrics.timer('fernet'):
+        return get_cipher(key).decrypt(data).decode('utf-8')
+
+
+# turn a number string into a canonical ticket (sorted tuple of numbers)
+def parse_numbers(numbers):
+    return tuple(sorted(int(n) for n in numbers.split()))
+
+
+# turn a ticket into its canonical number string
+def format_numbers(ticket):
+    return ' '.join(str(n) for n in sorted(ticket))
+
+
+# compact canonical form of a ticket: bit n is set for each number n
+def ticket_mask(ticket):
+    mask = 0
+    for n in ticket:
+        mask |= 1 << n
+    return mask
+
+
+# keyed, non-reversible token of a ticket so winners can be found without decrypting
+def match_token(ticket):
+    key = current_app.config['MATCH_TOKEN_KEY'].encode('utf-8')
+    return hmac.new(key, ticket_mask(ticket).to_bytes(8, 'big'), hashlib.sha256).hexdigest()
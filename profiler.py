@@ -0,0 +1,99 @@
+# IMPORTS
+import heapq
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+# CONFIG
+# slowest statements kept per request
+SLOWEST = 5
+# profiles of the latest requests, newest last
+recent = deque(maxlen=50)
+recent_lock = threading.Lock()
+# N+1 warnings are diagnostics rather than audit events: they go to stderr, not to the audit log (lottery.log)
+logger = logging.getLogger('profiler')
+logger.propagate = False
+logger.addHandler(logging.StreamHandler())
+
+
+# remember when a statement started
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+# add a finished statement to the profile of the current request
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+
+    # statements run outside a request (settlement jobs, scripts) are not profiled
+    if not has_request_context():
+        return
+
+    profile = g.get('query_profile')
+    if profile is None:
+        profile = g.query_profile = {'count': 0, 'time': 0.0, 'statements': Counter(), 'slowest': []}
+
+    profile['count'] += 1
+    profile['time'] += elapsed
+    # statements are parametrised, so a repeated text is the same query run again
+    profile['statements'][statement] += 1
+
+    heapq.heappush(profile['slowest'], (elapsed, statement))
+    if len(profile['slowest']) > SLOWEST:
+        heapq.heappop(profile['slowest'])
+
+
+# report the profile of a request in its headers and flag repeated statements
+def after_request(response):
+    profile = g.get('query_profile')
+    if profile is None:
+        return response
+
+    response.headers['X-Query-Count'] = str(profile['count'])
+    response.headers['X-Query-Time-Ms'] = '%.1f' % (profile['time'] * 1000)
+
+    threshold = current_app.config['QUERY_PROFILER_N_PLUS_ONE']
+    repeated = [(statement, count) for statement, count in profile['statements'].items() if count >= threshold]
+    if repeated:
+        response.headers['X-Query-N-Plus-One'] = str(max(count for statement, count in repeated))
+        for statement, count in repeated:
+            logger.warning('Possible N+1 query on %s: statement run %s times: %s',
+                           request.endpoint,
+                           count,
+                           ' '.join(statement.split()))
+
+    with recent_lock:
+        recent.append({
+            'endpoint': request.endpoint,
+            'path': request.path,
+            'count': profile['count'],
+            'time_ms': round(profile['time'] * 1000, 1),
+            'slowest': [{'time_ms': round(elapsed * 1000, 2), 'statement': ' '.join(statement.split())}
+                        for elapsed, statement in sorted(profile['slowest'], reverse=True)],
+            'repeated': [{'count': count, 'statement': ' '.join(statement.split())} for statement, count in repeated],
+        })
+
+    return response
+
+
+# profiles of the latest requests, newest first
+def recent_profiles():
+    with recent_lock:
+        return list(reversed(recent))
+
+
+# hook the profiler into the app's engines (when QUERY_PROFILER is set)
+def init_app(app, db):
+    if not app.config['QUERY_PROFILER']:
+        return
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    app.after_request(after_request)
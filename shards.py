@@ -0,0 +1,100 @@
+# IMPORTS
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import bindparam, update
+
+from app import db
+
+# CONFIG
+# Knuth's multiplicative hash (2^32 / golden ratio): consecutive user ids land on different shards
+HASH_MULTIPLIER = 2654435761
+# pool reading every shard at once for scatter-gather queries, created on first use
+executor = None
+executor_lock = threading.Lock()
+
+
+# bind key of shard n (shard 0 is the main database, which also keeps the winning draws)
+def bind_key(n):
+    return None if n == 0 else 'draws_%s' % n
+
+
+# database of shard n >= 1: DRAW_SHARD_URI with n filled in, or a file next to the main database
+def shard_uri(config, n):
+    if config['DRAW_SHARD_URI']:
+        return config['DRAW_SHARD_URI'] % n
+
+    root, extension = os.path.splitext(config['SQLALCHEMY_DATABASE_URI'])
+    return '%s-draws-%s%s' % (root, n, extension)
+
+
+# add the databases of shards 1 to DRAW_SHARDS - 1 to an app's binds (before db.init_app)
+def configure(app):
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for n in range(1, app.config['DRAW_SHARDS']):
+        binds[bind_key(n)] = shard_uri(app.config, n)
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+
+# number of shards of the current app
+def count():
+    return current_app.config['DRAW_SHARDS']
+
+
+# shard holding a user's draws
+def shard_of(user_id):
+    return (user_id * HASH_MULTIPLIER % 2 ** 32) * count() >> 32
+
+
+# engine of shard n
+def engine(n):
+    return db.engines[bind_key(n)]
+
+
+# run a statement on shard n on the current session's connection to it (committed with the session).
+# Statements go to the connection rather than through session.execute, whose ORM bulk INSERT ignores the
+# bind and would write to the main database
+def execute(n, statement, params=None):
+    return db.session.connection(bind_arguments={'bind': engine(n)}).execute(statement, params)
+
+
+# update rows of a model on shard n by primary key, each row a dict of its id and new values, with one
+# executemany (the Core form of an ORM bulk update, which would also ignore the bind)
+def update_by_id(n, model, rows):
+    table = model.__table__
+    statement = update(table) \
+        .where(table.c.id == bindparam('row_id')) \
+        .values({name: bindparam('row_' + name) for name in rows[0] if name != 'id'})
+    return execute(n, statement, [{'row_' + name: value for name, value in row.items()} for row in rows])
+
+
+# run a statement on the shard of a user's draws
+def execute_for(user_id, statement, params=None):
+    return execute(shard_of(user_id), statement, params)
+
+
+# get the pool reading the shards
+def get_executor():
+    global executor
+
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=count(), thread_name_prefix='shards')
+
+    return executor
+
+
+# run a read on every shard at once, each on a connection of its own (so it does not see uncommitted
+# changes of the session), returning the rows of each shard in shard order
+def scatter(statement):
+    if count() == 1:
+        return [execute(0, statement).all()]
+
+    def read(shard_engine):
+        with shard_engine.connect() as connection:
+            return connection.execute(statement).all()
+
+    # SQLite releases the GIL while it steps through a query, so the shards are read in parallel
+    return list(get_executor().map(read, [engine(n) for n in range(count())]))
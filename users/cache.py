@@ -0,0 +1,80 @@
+# IMPORTS
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from app import db
+from models import User
+
+# CONFIG
+# detached users by id with the time they expire
+users = {}
+users_lock = threading.Lock()
+
+
+# get a cached (detached) user, or None if missing or expired
+def get(user_id):
+    with users_lock:
+        entry = users.get(user_id)
+
+        if entry is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            del users[user_id]
+            return None
+
+        return entry[1]
+
+
+# cache a detached user for USER_CACHE_TTL seconds
+def put(user):
+    with users_lock:
+        users[user.id] = (time.monotonic() + current_app.config['USER_CACHE_TTL'], user)
+
+
+# drop a user from the cache (logout, password, role or key change)
+def invalidate(user_id):
+    with users_lock:
+        users.pop(user_id, None)
+
+
+# load the user of a request, from the cache when possible
+def load_user(user_id):
+    if not current_app.config['USER_CACHE']:
+        return db.session.get(User, user_id)
+
+    cached = get(user_id)
+
+    if cached is None:
+        user = db.session.get(User, user_id)
+        if not user:
+            return None
+
+        # keep a detached copy, so later requests do not share this request's session
+        db.session.expunge(user)
+        put(user)
+        cached = user
+
+    # attach a copy to this request's session without a SELECT, so changes to it are still saved
+    return db.session.merge(cached, load=False)
+
+
+# any change to a user (password, role, key, logins) invalidates its cached copy once it is committed: dropped
+# at flush, the old row could be read and cached again by another request before the commit
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def record_changed(mapper, connection, target):
+    object_session(target).info.setdefault('changed_users', set()).add(target.id)
+
+
+# drop the users changed in a transaction when it ends (a rolled back change leaves the cached copy valid,
+# but dropping it costs one SELECT)
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def invalidate_changed(session):
+    for user_id in session.info.pop('changed_users', ()):
+        invalidate(user_id)
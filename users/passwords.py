@@ -0,0 +1,63 @@
+# IMPORTS
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from flask import abort, current_app
+
+import metrics
+
+# CONFIG
+# pool hashing and checking passwords, created on first use
+executor = None
+# free places in the pool (running plus queued calls)
+slots = None
+executor_lock = threading.Lock()
+
+
+# get the pool and its slots
+def get_executor():
+    global executor, slots
+
+    with executor_lock:
+        if executor is None:
+            workers = current_app.config['BCRYPT_WORKERS']
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+            slots = threading.BoundedSemaphore(workers + current_app.config['BCRYPT_QUEUE_DEPTH'])
+
+    return executor, slots
+
+
+# run a bcrypt call in the pool, rejecting it with 503 at once when the pool and its queue are full
+def run(function, *args):
+    pool, free = get_executor()
+
+    if not free.acquire(blocking=False):
+        abort(503)
+
+    try:
+        # bcrypt releases the GIL, so other requests keep running while this one waits
+        with metrics.timer('bcrypt'):
+            return pool.submit(function, *args).result()
+    finally:
+        free.release()
+
+
+# hash a password at the configured cost
+def hash_password(password):
+    return run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(current_app.config['BCRYPT_ROUNDS']))
+
+
+# check a password against its hash
+def check_password(password, hashed):
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+
+# check if a hash was made at a different cost than the configured one
+def needs_rehash(hashed):
+    if isinstance(hashed, bytes):
+        hashed = hashed.decode('utf-8')
+    # hashes look like $2b$12$...
+    return int(hashed.split('$')[2]) != current_app.config['BCRYPT_ROUNDS']
@@ -7,6 +7,7 @@ from markupsafe import Markup
 
 from app import db
 from models import User
+from users import cache
 from users.forms import RegisterForm, LoginForm, ChangePasswordForm
 from flask_login import login_user, current_user, logout_user, login_required
 
@@ -27,7 +28,12 @@ def register():
                         current_user.id,
                         current_user.role,
                         request.remote_addr,
-                        datetime.now())
+                        datetime.now(),
+                        extra={'event': 'restricted_access',
+                               'user': current_user.email,
+                               'user_id': current_user.id,
+                               'role': current_user.role,
+                               'ip': request.remote_addr})
 
         return render_template('errors/403.html')
 
@@ -56,7 +62,8 @@ def register():
         logging.warning('User [%s, %s] registered on %s',
                         form.email.data,
                         request.remote_addr,
-                        registered_on)
+                        registered_on,
+                        extra={'event': 'register', 'user': form.email.data, 'ip': request.remote_addr})
 
         # add the new user to the database
         db.session.add(new_user)
@@ -82,7 +89,12 @@ def login():
                         current_user.id,
                         current_user.role,
                         request.remote_addr,
-                        datetime.now())
+                        datetime.now(),
+                        extra={'event': 'restricted_access',
+                               'user': current_user.email,
+                               'user_id': current_user.id,
+                               'role': current_user.role,
+                               'ip': request.remote_addr})
 
         return render_template('errors/403.html')
     # if no attempts set to 0
@@ -98,7 +110,8 @@ def login():
             logging.warning('User [%s, %s] has failed the login attempt on [%s]',
                             form.email.data,
                             request.remote_addr,
-                            datetime.now())
+                            datetime.now(),
+                            extra={'event': 'login_failed', 'user': form.email.data, 'ip': request.remote_addr})
             # add one attempt
             session['authentication_attempts'] += 1
             # if 3 or more attempts block the form
@@ -110,6 +123,8 @@ def login():
             flash(
                 f'Invalid credentials, user does not exist, incorrect PIN or recaptcha is not completed! {attempts_remaining} login attempts remaining.')
             return render_template('users/login.html', form=form)
+        # rehash the password if the bcrypt cost has changed
+        user.upgrade_password(form.password.data)
         # login the user
         login_user(user)
         # set authentication attempts to 0
@@ -125,7 +140,12 @@ def login():
                         current_user.id,
                         request.remote_addr,
                         current_user.current_login,
-                        current_user.last_login)
+                        current_user.last_login,
+                        extra={'event': 'login',
+                               'user': form.email.data,
+                               'user_id': current_user.id,
+                               'role': current_user.role,
+                               'ip': request.remote_addr})
         # redirect to admin page if the users role is admin
         if current_user.role != 'user':
             return redirect(url_for('admin.admin'))
@@ -144,8 +164,13 @@ def logout():
                     current_user.email,
                     current_user.id,
                     request.remote_addr,
-                    datetime.now())
+                    datetime.now(),
+                    extra={'event': 'logout',
+                           'user': current_user.email,
+                           'user_id': current_user.id,
+                           'ip': request.remote_addr})
     # logout the user
+    cache.invalidate(current_user.id)
     logout_user()
     session['authentication_attempts'] = 0
 
@@ -174,7 +199,12 @@ def setup_2fa():
                         current_user.id,
                         current_user.role,
                         request.remote_addr,
-                        datetime.now())
+                        datetime.now(),
+                        extra={'event': 'restricted_access',
+                               'user': current_user.email,
+                               'user_id': current_user.id,
+                               'role': current_user.role,
+                               'ip': request.remote_addr})
 
         return render_template('errors/403.html')
     # check if user has just registered
@@ -205,7 +235,12 @@ def reset():
                         current_user.id,
                         current_user.role,
                         request.remote_addr,
-                        datetime.now())
+                        datetime.now(),
+                        extra={'event': 'restricted_access',
+                               'user': current_user.email,
+                               'user_id': current_user.id,
+                               'role': current_user.role,
+                               'ip': request.remote_addr})
 
         return render_template('errors/403.html')
     # reset the attempts